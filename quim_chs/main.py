@@ -10,6 +10,8 @@ csvfiles = ('Export_1970_1979.csv', 'Export_1980_1989.csv',
             'Export_1990_1999.csv', 'Export_2000_2009.csv',
             'Export_2010_2019.csv', 'Export_2020_2029.csv')
 dbname = r'D:\IGME20\20211124_calidad_subt_chs\data\quim_chs.db'
+# processes used to read the csv files and to compute the outliers
+workers = 4
 
 if __name__ == "__main__":
 
@@ -27,9 +29,10 @@ if __name__ == "__main__":
         # create_tables(dbname)
 
         # insert(csvfiles, csvpath, dbname, update_puntos = False,
-        #        exception = False, insert_update = True)
+        #        exception = False, insert_update = True, bulk = True,
+        #        workers = workers)
 
-        ooutliers(dbname)
+        ooutliers(dbname, workers=workers)
 
         end = time()
         print('ellapsed time ', end-start)
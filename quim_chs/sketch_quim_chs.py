@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 10:05:48 2026
+
+@author: solis
+
+Resúmenes de cuantiles (t-digest) de los valores de cada grupo (fid, param)
+de la tabla analisis, guardados en la tabla sketches de la db sqlite. insert
+los actualiza con las filas nuevas, de modo que los límites del IQR se
+obtienen sin volver a leer toda la tabla analisis.
+
+Mientras un grupo tiene como mucho 2 * delta valores el resumen los guarda
+todos y los cuartiles son exactos (los mismos que np.percentile); con más
+valores se agrupan en centroides, más pequeños cerca de los extremos, y los
+cuartiles son aproximados.
+"""
+import numpy as np
+import sqlite3
+
+# número mínimo de valores de un grupo para marcar los valores nuevos como
+# outliers
+SKETCH_MIN_N = 8
+
+create_sketches = """
+create table if not exists sketches(
+    fid text,
+    param text,
+    n integer,
+    means blob,
+    weights blob,
+    primary key (fid, param)
+)
+"""
+
+create_outliers_new = """
+create table if not exists outliers_new(
+    fid text,
+    fecha text,
+    param text,
+    valor real,
+    lower real,
+    upper real,
+    primary key (fid, fecha, param)
+)
+"""
+
+
+class Quantile_sketch():
+
+    def __init__(self, delta: int = 100, means: np.ndarray = None,
+                 weights: np.ndarray = None):
+        """
+        Parameters
+        ----------
+        delta : int
+            parámetro de compresión; el número de centroides es del orden
+            de delta
+        means : np.ndarray
+            medias de los centroides, ordenadas
+        weights : np.ndarray
+            número de valores de cada centroide
+
+        Returns
+        -------
+        None.
+
+        """
+        self.delta = delta
+        if means is None:
+            means = np.empty(0, dtype=np.float64)
+            weights = np.empty(0, dtype=np.float64)
+        self.means = means
+        self.weights = weights
+
+
+    @property
+    def n(self) -> int:
+        return int(self.weights.sum())
+
+
+    def update(self, values) -> None:
+        """
+        Añade valores al resumen
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return
+        means = np.concatenate((self.means, values))
+        weights = np.concatenate((self.weights, np.ones(values.size)))
+        order = np.argsort(means, kind='stable')
+        self.means = means[order]
+        self.weights = weights[order]
+        if self.means.size > 2 * self.delta:
+            self.__compress()
+
+
+    def __compress(self) -> None:
+        # une centroides consecutivos mientras su peso no supera
+        # 4 n q (1 - q) / delta, siendo q el cuantil de su centro
+        total = self.weights.sum()
+        means = [self.means[0]]
+        weights = [self.weights[0]]
+        before = 0.
+        for m, w in zip(self.means[1:], self.weights[1:]):
+            proposed = weights[-1] + w
+            q = (before + proposed / 2.) / total
+            if proposed <= max(1., 4. * total * q * (1. - q) / self.delta):
+                means[-1] = (means[-1] * weights[-1] + m * w) / proposed
+                weights[-1] = proposed
+            else:
+                before += weights[-1]
+                means.append(m)
+                weights.append(w)
+        self.means = np.array(means)
+        self.weights = np.array(weights)
+
+
+    def quantile(self, p: float) -> float:
+        """
+        Cuantil p (0 <= p <= 1), interpolado linealmente como en
+        np.percentile
+        """
+        if self.means.size == 0:
+            return np.nan
+        # posición del centro de cada centroide en los valores ordenados
+        centers = np.cumsum(self.weights) - (self.weights + 1.) / 2.
+        return float(np.interp((self.n - 1) * p, centers, self.means))
+
+
+    def bounds(self, k: float = 1.5) -> tuple:
+        """
+        Returns
+        -------
+        tuple
+            (q1, q3, iqr, Q1 - k IQR, Q3 + k IQR)
+        """
+        q1 = self.quantile(0.25)
+        q3 = self.quantile(0.75)
+        iqr = q3 - q1
+        return q1, q3, iqr, q1 - k * iqr, q3 + k * iqr
+
+
+    def to_blobs(self) -> tuple:
+        return self.means.tobytes(), self.weights.tobytes()
+
+
+    @classmethod
+    def from_blobs(cls, means: bytes, weights: bytes, delta: int = 100):
+        return cls(delta, np.frombuffer(means, dtype=np.float64).copy(),
+                   np.frombuffer(weights, dtype=np.float64).copy())
+
+
+def sketch_get(cur, fid: str, param: str, delta: int = 100):
+    """
+    Resumen de (fid, param) guardado en la tabla sketches; si no existe
+    devuelve uno vacío
+    """
+    cur.execute("""
+        select means, weights
+        from sketches
+        where fid = ? and param = ?
+        """, (fid, param))
+    row = cur.fetchone()
+    if row is None:
+        return Quantile_sketch(delta)
+    return Quantile_sketch.from_blobs(row[0], row[1], delta)
+
+
+def sketches_write(cur, sketches: dict) -> None:
+    """
+    Graba los resúmenes {(fid, param): Quantile_sketch} en la tabla
+    sketches
+    """
+    cur.executemany("""
+        insert or replace into sketches(fid, param, n, means, weights)
+        values (?, ?, ?, ?, ?)
+        """, ((fid, param, sketch.n, *sketch.to_blobs())
+              for (fid, param), sketch in sketches.items()))
+
+
+def sketches_build(cur, delta: int = 100) -> None:
+    """
+    Rehace todos los resúmenes de la tabla sketches a partir de la tabla
+    analisis
+    """
+    cur.execute(create_sketches)
+    cur.execute('delete from sketches')
+    cur.execute("""
+        select fid, param, valor
+        from analisis
+        where typeof(valor) in ('real', 'integer')
+        order by fid, param
+        """)
+    sketches = {}
+    key, values = None, []
+    for fid, param, valor in cur.fetchall():
+        if (fid, param) != key:
+            if key is not None:
+                sketches[key] = Quantile_sketch(delta)
+                sketches[key].update(values)
+            key, values = (fid, param), []
+        values.append(valor)
+    if key is not None:
+        sketches[key] = Quantile_sketch(delta)
+        sketches[key].update(values)
+    sketches_write(cur, sketches)
+
+
+def sketch_bounds(dbname: str, k: float = 1.5) -> list:
+    """
+    Límites del IQR de todos los grupos (fid, param) a partir de la tabla
+    sketches, sin leer la tabla analisis
+
+    Returns
+    -------
+    list
+        [(fid, param, n, q1, q3, iqr, lower, upper)], como las filas de la
+        tabla outliers_bounds de ooutliers
+
+    """
+    con = sqlite3.connect(dbname)
+    try:
+        cur = con.cursor()
+        cur.execute("""
+            select fid, param, n, means, weights
+            from sketches
+            order by fid, param
+            """)
+        return [(fid, param, n,
+                 *Quantile_sketch.from_blobs(means, weights).bounds(k))
+                for fid, param, n, means, weights in cur.fetchall()]
+    finally:
+        con.close()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 09:40:11 2026
+
+@author: solis
+
+Tests of upsert_quim_chs; run with pytest from this directory
+"""
+import numpy as np
+import pytest
+
+from upsert_quim_chs import iqr_bounds
+
+
+def test_iqr_bounds_colliding_keys():
+    # ('01', '12') and ('011', '2') are the same string when concatenated
+    rng = np.random.default_rng(0)
+    keys = [('01', '12'), ('011', '2'), ('0', '112'), ('01', '2')]
+    fids, params, values = [], [], []
+    for i, (fid, param) in enumerate(keys):
+        n = 10 + 5 * i
+        fids += [fid] * n
+        params += [param] * n
+        values.append(rng.normal(10. * i, 1., n))
+    fids = np.array(fids, dtype=object)
+    params = np.array(params, dtype=object)
+    values = np.concatenate(values)
+
+    bounds, group, lower, upper = iqr_bounds(fids, params, values)
+
+    assert [b[0:2] for b in bounds] == sorted(keys)
+    for fid, param, n, q1, q3, iqr, glower, gupper in bounds:
+        sel = (fids == fid) & (params == param)
+        assert n == np.count_nonzero(sel)
+        assert np.allclose((q1, q3), np.percentile(values[sel], [25, 75]))
+        assert np.allclose(lower[sel], q1 - 1.5 * iqr)
+        assert np.allclose(upper[sel], q3 + 1.5 * iqr)
+
+
+def test_ooutliers_workers_same_result(tmp_path):
+    import sqlite3
+    from upsert_quim_chs import create_tables, ooutliers
+
+    dbname = str(tmp_path / 'quim_chs.db')
+    create_tables(dbname)
+    rng = np.random.default_rng(1)
+    rows = []
+    for fid in ('0', '01', '011', '02', '021', '1', '12'):
+        for param in ('1', '12', '112', '2', '21'):
+            for day in range(int(rng.integers(1, 30))):
+                rows.append((fid, f'2000-01-{day + 1:02d}', param,
+                             float(rng.lognormal(1., 1.)), 'mg/l'))
+    con = sqlite3.connect(dbname)
+    con.executemany('insert into analisis values (?, ?, ?, ?, ?)', rows)
+    con.commit()
+
+    def tables_get():
+        return [con.execute(f'select * from {table} order by 1, 2, 3')
+                .fetchall() for table in ('outliers_bounds', 'outliers')]
+
+    try:
+        ooutliers(dbname)
+        expected = tables_get()
+        for workers in (2, 3, 4):
+            ooutliers(dbname, workers=workers)
+            for rows1, rows2 in zip(expected, tables_get()):
+                assert len(rows1) == len(rows2)
+                for row1, row2 in zip(rows1, rows2):
+                    assert row1 == row2
+    finally:
+        con.close()
+
+
+def test_sketches_seeded_from_analisis(tmp_path):
+    import sqlite3
+    from upsert_quim_chs import create_tables, insert
+
+    dbname = str(tmp_path / 'quim_chs.db')
+    create_tables(dbname)
+    con = sqlite3.connect(dbname)
+    con.executemany('insert into analisis values (?, ?, ?, ?, ?)',
+                    [('01', f'2000-01-{day:02d}', '12', float(day), 'mg/l')
+                     for day in range(1, 20)])
+    con.commit()
+    try:
+        insert([], str(tmp_path), dbname, sketches=True)
+        assert con.execute('select fid, param, n from sketches') \
+            .fetchall() == [('01', '12', 19)]
+    finally:
+        con.close()
+
+
+def test_columns_convert_blank_lines():
+    from upsert_quim_chs import COLUMN_SCHEMA, columns_convert
+
+    ncols = len(COLUMN_SCHEMA)
+    row = ['1'] * ncols
+    rows = [row, [], row[:], []]
+    rows[2][0] = 'null'
+    msgs, nulls = [], {}
+    columns = columns_convert(rows, 1, 'f.csv', False, nulls, msgs)
+    assert all(len(values) == 2 for values in columns.values())
+    target = next(iter(COLUMN_SCHEMA.values()))[0]
+    assert nulls == {target: 1}
+    assert msgs[0].endswith('lines: 3')
+
+
+def test_file_chunks_header(tmp_path):
+    from upsert_quim_chs import column_names, file_chunks
+
+    row = ['1'] * len(column_names)
+    (tmp_path / 'ok.csv').write_text(
+        '\n'.join(';'.join(r) for r in (column_names, row)) + '\n',
+        encoding='utf-8-sig')
+    chunks = list(file_chunks('ok.csv', str(tmp_path), ';', True, {}))
+    assert len(chunks) == 1
+    assert chunks[0]['fid'] == ['1']
+
+    reordered = list(column_names)
+    reordered[5], reordered[6] = reordered[6], reordered[5]
+    (tmp_path / 'bad.csv').write_text(
+        '\n'.join(';'.join(r) for r in (reordered, row)) + '\n',
+        encoding='utf-8')
+    with pytest.raises(ValueError, match='bad.csv'):
+        list(file_chunks('bad.csv', str(tmp_path), ';', True, {}))
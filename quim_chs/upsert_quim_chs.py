@@ -5,21 +5,127 @@ Created on Sat Nov 16 21:00:03 2019
 insert data in table ipa2 from a csv file
 """
 
+from concurrent.futures import ProcessPoolExecutor
 import csv
-from os.path import join
+from io import StringIO
+from itertools import islice
+import multiprocessing as mp
+from os.path import abspath, join
 import numpy as np
+import queue
 import sqlite3
 from sqlite3 import Error
 import traceback
+from urllib.request import pathname2url
 
 import littleLogging as logging
+from sketch_quim_chs import SKETCH_MIN_N, create_outliers_new, \
+    create_sketches, sketch_get, sketches_build, sketches_write
 
 column_names = ('Estación', 'FechaToma', 'Param Cod', 'Param Nom',
                 'Unidades', 'Valor', 'X_ETRS89', 'Y_ETRS89', 'Cod Masa',
                 'Nombre Masa', 'Municipio', 'Provincia', 'UH Geo',
                 'UH Geo Nombre', 'Acuifero', 'PROFUNDIDAD')
 
-def create_tables(dbname: str):
+# columna csv: (columna destino, tipo, requerida)
+_COLUMN_TARGETS = {
+    'Estación': ('fid', str, True),
+    'FechaToma': ('fecha', str, True),
+    'Param Cod': ('param', str, True),
+    'Param Nom': ('param_name', str, True),
+    'Unidades': ('uds', str, False),
+    'Valor': ('valor', float, True),
+    'X_ETRS89': ('xetrs89', float, True),
+    'Y_ETRS89': ('yetrs89', float, True),
+    'Cod Masa': ('id_mas', str, True),
+    'Nombre Masa': ('mas_name', str, False),
+    'Municipio': ('tm', str, False),
+    'Provincia': ('prov', str, False),
+    'UH Geo': ('id_uh', str, True),
+    'UH Geo Nombre': ('uh_name', str, False),
+    'Acuifero': ('acu', str, False),
+    'PROFUNDIDAD': ('prof', float, False)}
+
+# esquema de las columnas de los ficheros csv, en el orden de column_names;
+# falla al importar el módulo si falta una columna en _COLUMN_TARGETS
+COLUMN_SCHEMA = {name: _COLUMN_TARGETS[name] for name in column_names}
+
+# contenido de las celdas nulas
+NULLS = ('null', 'NULL', 'Null')
+
+# filas de los ficheros csv que se convierten de una vez
+READ_CHUNK = 20000
+
+# número máximo de líneas con null que se escriben en el log por columna y
+# bloque de filas
+MAX_NULL_LINES = 10
+
+# pragmas de sqlite durante una carga masiva (bulk=True en insert)
+BULK_PRAGMAS = {'journal_mode': 'wal', 'synchronous': 'off',
+                'cache_size': -200000, 'temp_store': 'memory'}
+
+# esquema de las tablas en postgres (target='postgres' en insert)
+PG_SCHEMA = 'quim_chs'
+
+# columnas de las tablas en el orden de las filas de dimension_rows_get y
+# analisis_rows_get, y columnas de su primary key
+TABLE_COLUMNS = {'puntos': ('fid', 'xetrs89', 'yetrs89', 'id_mas', 'tm',
+                            'prov', 'id_uh', 'acu', 'prof'),
+                 'masub': ('fid', 'name'),
+                 'param': ('fid', 'name'),
+                 'uh': ('fid', 'name'),
+                 'analisis': ('fid', 'fecha', 'param', 'valor', 'uds')}
+TABLE_KEYS = {'puntos': ('fid',), 'masub': ('fid',), 'param': ('fid',),
+              'uh': ('fid',), 'analisis': ('fid', 'fecha', 'param')}
+
+
+def pragmas_set(con, pragmas: dict) -> dict:
+    """
+    Asigna los pragmas de sqlite y devuelve sus valores anteriores para
+    poder restaurarlos; journal_mode no se puede cambiar dentro de una
+    transacción
+    """
+    old = {}
+    for name, value in pragmas.items():
+        old[name] = con.execute(f'pragma {name}').fetchone()[0]
+        con.execute(f'pragma {name} = {value}')
+    return old
+
+
+# índices secundarios de la tabla analisis: nombre: columnas
+ANALISIS_INDEXES = {'analisis_param_fecha': '(param, fecha)',
+                    'analisis_fid_param': '(fid, param)'}
+
+
+def analisis_stage_merge(cur) -> None:
+    """
+    Pasa las filas de la tabla de carga analisis_stage, sin índices, a
+    analisis, que debe estar vacía, y construye los índices al final: las
+    filas se insertan en el orden de la primary key, de modo que su índice
+    se construye en un solo recorrido, y los duplicados se eliminan en la
+    misma sentencia (se conserva la primera fila cargada)
+    """
+    for name in ANALISIS_INDEXES:
+        cur.execute(f'drop index if exists {name}')
+    cur.execute("""
+        insert or ignore into analisis(fid, fecha, param, valor, uds)
+        select fid, fecha, param, valor, uds
+        from analisis_stage
+        order by fid, fecha, param, rowid
+        """)
+    cur.execute('drop table analisis_stage')
+    for name, columns in ANALISIS_INDEXES.items():
+        cur.execute(f'create index if not exists {name} on analisis{columns}')
+
+
+def create_tables(dbname: str, target: str = 'sqlite'):
+    """
+    Crea las tablas si no existen; con target='postgres' dbname es la db
+    de con_get y las tablas se crean en el esquema PG_SCHEMA
+    """
+    if target == 'postgres':
+        create_tables_pg(dbname)
+        return
     com1 = """
     create table if not exists puntos(
         fid text primary key,
@@ -67,6 +173,9 @@ def create_tables(dbname: str):
         commands = (com1, com2, com3, com4, com5)
         for command in commands:
             cur.execute(command)
+        for name, columns in ANALISIS_INDEXES.items():
+            cur.execute(f'create index if not exists {name} on '
+                        f'analisis{columns}')
 
     except Error:
         raise ValueError(Error)
@@ -74,11 +183,261 @@ def create_tables(dbname: str):
         con.close()
 
 
+def create_tables_pg(db: str):
+    from db_connection import con_get
+    types = {'xetrs89': 'double precision', 'yetrs89': 'double precision',
+             'prof': 'double precision', 'valor': 'double precision'}
+    con = con_get('postgres', db)
+    try:
+        cur = con.cursor()
+        cur.execute(f'create schema if not exists {PG_SCHEMA}')
+        for table, columns in TABLE_COLUMNS.items():
+            columns = ', '.join(f'{col} {types.get(col, "text")}'
+                                for col in columns)
+            keys = ', '.join(TABLE_KEYS[table])
+            cur.execute(f'create table if not exists {PG_SCHEMA}.{table}'
+                        f'({columns}, primary key ({keys}))')
+        for name, columns in ANALISIS_INDEXES.items():
+            cur.execute(f'create index if not exists {name} on '
+                        f'{PG_SCHEMA}.analisis{columns}')
+        con.commit()
+    finally:
+        con.close()
+
+
+def columns_convert(rows: list, first_line: int, file: str,
+                    exception: bool, cols_with_null_values: dict,
+                    msgs: list = None) -> dict:
+    """
+    Convierte un bloque de filas de un fichero csv según COLUMN_SCHEMA, una
+    columna cada vez
+
+    Parameters
+    ----------
+    rows : list
+        filas leídas con csv.reader; las vacías (líneas en blanco) se
+        descartan y las que tienen menos columnas se completan con null
+    first_line : int
+        número de línea de la primera fila de rows
+    file : str
+        nombre del fichero, para los mensajes
+    exception : bool
+        si True lanza un ValueError si una columna requerida tiene nulls
+    cols_with_null_values : dict
+        {columna destino: número de nulls}; se actualiza
+    msgs : list
+        si no es None los mensajes se añaden a msgs en vez de escribirse en
+        el log
+
+    Returns
+    -------
+    dict
+        {columna destino: lista de valores}; los nulls son '' en las
+        columnas str y None en las float
+
+    """
+    # número de línea de cada fila no vacía
+    line_numbers = np.array([first_line + i for i, row in enumerate(rows)
+                             if row], dtype=np.int64)
+    rows = [row for row in rows if row]
+    columns = {}
+    for j, (target, type_, required) in enumerate(COLUMN_SCHEMA.values()):
+        # sólo se crea el array de una columna: el ancho de un array str es
+        # el de su valor más largo
+        col = np.array([row[j] if j < len(row) else 'null' for row in rows],
+                       dtype=str)
+        nulls = np.isin(col, NULLS)
+        inulls = np.flatnonzero(nulls)
+        if inulls.size > 0:
+            cols_with_null_values[target] = \
+                cols_with_null_values.get(target, 0) + inulls.size
+            lines = ', '.join(str(i)
+                              for i in line_numbers[inulls[:MAX_NULL_LINES]])
+            if inulls.size > MAX_NULL_LINES:
+                lines += ', ...'
+            msg = f'file {file}, {target} is null in {inulls.size:n} ' +\
+                f'lines: {lines}'
+            if msgs is None:
+                logging.append(msg, toScreen=False)
+            else:
+                msgs.append(msg)
+            if required and exception:
+                raise ValueError(msg)
+        if type_ is float:
+            values = np.char.replace(np.where(nulls, 'nan', col), ',', '.')
+            values = values.astype(np.float64).astype(object)
+            values[nulls] = None
+        else:
+            values = np.where(nulls, '', col)
+        columns[target] = values.tolist()
+    return columns
+
+
+def file_chunks(file: str, csvpath: str, sep: str, exception: bool,
+                cols_with_null_values: dict, msgs: list = None):
+    """
+    Generador de los bloques de READ_CHUNK filas de un fichero csv
+    convertidos con columns_convert; las columnas se asignan por su
+    posición, así que si la cabecera no empieza por column_names lanza un
+    ValueError
+    """
+    with open(join(csvpath, file), 'r', encoding='utf-8') as fi:
+        csv_reader = csv.reader(fi, delimiter=sep)
+        header = next(csv_reader, None)
+        if header is None:
+            return
+        header = [name.strip().lstrip('\ufeff')
+                  for name in header[:len(column_names)]]
+        if tuple(header) != column_names:
+            raise ValueError(f'file {file}, the columns are {header}, ' +
+                             f'must be {list(column_names)}')
+        first_line = 1
+        while True:
+            rows = list(islice(csv_reader, READ_CHUNK))
+            if not rows:
+                break
+            yield columns_convert(rows, first_line, file, exception,
+                                  cols_with_null_values, msgs)
+            first_line += len(rows)
+
+
+# cola y evento de parada de los procesos que leen los ficheros en insert
+# con workers > 1
+_parse_queue = None
+_parse_stop = None
+
+
+def _parse_init(parse_queue, parse_stop):
+    global _parse_queue, _parse_stop
+    _parse_queue = parse_queue
+    _parse_stop = parse_stop
+    # el proceso puede terminar aunque queden datos sin leer en la cola
+    _parse_queue.cancel_join_thread()
+
+
+def _parse_put(item: tuple) -> bool:
+    # espera mientras la cola está llena, salvo que se pida parar
+    while not _parse_stop.is_set():
+        try:
+            _parse_queue.put(item, timeout=1.)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def file_parse(file: str, csvpath: str, sep: str, exception: bool) -> None:
+    """
+    Lee y convierte un fichero csv en un proceso de insert; manda a la cola
+    (tipo, file, datos, mensajes) con tipo:
+        'chunk': datos son las columnas de un bloque de filas
+        'end': el fichero se ha leído; datos es cols_with_null_values
+        'error': datos es el traceback del error
+    """
+    cols_with_null_values = {}
+    msgs = []
+    try:
+        for columns in file_chunks(file, csvpath, sep, exception,
+                                   cols_with_null_values, msgs):
+            # la cola serializa los datos después de put
+            if not _parse_put(('chunk', file, columns, msgs[:])):
+                return
+            msgs.clear()
+    except Exception:
+        _parse_put(('error', file, traceback.format_exc(), msgs))
+        return
+    _parse_put(('end', file, cols_with_null_values, msgs))
+
+
+def chunks_get(csvfiles: list, csvpath: str, sep: str, exception: bool,
+               cols_with_null_values: dict, workers: int = 1,
+               queue_size: int = 16):
+    """
+    Generador de (file, columns) de cada bloque de filas convertido de
+    csvfiles; columns es None cuando se ha leído todo el fichero. Con
+    workers > 1 los ficheros se leen en procesos que mandan los bloques por
+    una cola de tamaño queue_size (ver file_parse)
+    """
+    if workers <= 1:
+        for file in csvfiles:
+            print(file)
+            for columns in file_chunks(file, csvpath, sep, exception,
+                                       cols_with_null_values):
+                yield file, columns
+            yield file, None
+        return
+
+    parse_queue = mp.Queue(maxsize=queue_size)
+    parse_stop = mp.Event()
+    executor = ProcessPoolExecutor(max_workers=workers,
+                                   initializer=_parse_init,
+                                   initargs=(parse_queue, parse_stop))
+    try:
+        futures = [executor.submit(file_parse, file, csvpath, sep,
+                                   exception)
+                   for file in csvfiles]
+        pending = len(futures)
+        while pending > 0:
+            try:
+                kind, file, data, msgs = parse_queue.get(timeout=1.)
+            except queue.Empty:
+                # un proceso que termina de forma anormal no avisa
+                for future in futures:
+                    if future.done() and future.exception() is not None:
+                        raise future.exception()
+                continue
+            for msg in msgs:
+                logging.append(msg, toScreen=False)
+            if kind == 'error':
+                raise ValueError(f'file {file}\n{data}')
+            elif kind == 'end':
+                pending -= 1
+                print(file)
+                for key, value in data.items():
+                    cols_with_null_values[key] = \
+                        cols_with_null_values.get(key, 0) + value
+                yield file, None
+            else:
+                yield file, data
+    finally:
+        parse_stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def dimension_rows_get(columns: dict) -> dict:
+    """
+    Filas de las tablas de dimensiones de un bloque de filas convertido
+    """
+    c = columns
+    return {'puntos': zip(c['fid'], c['xetrs89'], c['yetrs89'], c['id_mas'],
+                          c['tm'], c['prov'], c['id_uh'], c['acu'],
+                          c['prof']),
+            'masub': zip(c['id_mas'], c['mas_name']),
+            'param': zip(c['param'], c['param_name']),
+            'uh': zip(c['id_uh'], c['uh_name'])}
+
+
+def analisis_rows_get(columns: dict) -> list:
+    """
+    Filas de la tabla analisis de un bloque de filas convertido
+    """
+    c = columns
+    return list(zip(c['fid'], c['fecha'], c['param'], c['valor'], c['uds']))
+
+
 def insert(csvfiles: list, csvpath: str, db: str,
            sep: str =';',
            update_puntos: bool = True,
            exception:bool = True,
-           insert_update: bool = True) -> None:
+           insert_update: bool = True,
+           bulk: bool = False,
+           batch_size: int = 50000,
+           staged: bool = False,
+           workers: int = 1,
+           queue_size: int = 16,
+           sketches: bool = False,
+           k: float = 1.5,
+           target: str = 'sqlite') -> None:
     """
 
     Parameters
@@ -98,15 +457,48 @@ def insert(csvfiles: list, csvpath: str, db: str,
         con contenido null
     insert_update:
         si True realiza un insert/update de las tablas a partir de csvfiles
+    bulk:
+        si True las filas se insertan por lotes con executemany e insert or
+        ignore, con los pragmas BULK_PRAGMAS durante la carga, que se
+        restauran al terminar; si False fila a fila
+    batch_size:
+        número de filas de cada lote si bulk es True
+    staged:
+        carga inicial rápida: si True y la tabla analisis está vacía, las
+        filas se cargan en modo bulk en la tabla analisis_stage, sin
+        índices, y al final se pasan a analisis sin duplicados y se
+        construyen los índices (analisis_stage_merge); si analisis tiene
+        filas se usa el modo normal
+    workers:
+        si es mayor que 1, número de procesos que leen y convierten los
+        ficheros a la vez; los bloques de filas convertidos se mandan por
+        una cola de tamaño queue_size a este proceso, el único que escribe
+        en la db. Si una clave de analisis o de una tabla de dimensiones
+        está en varios ficheros se conserva la fila que se escribe primero
+    queue_size:
+        número máximo de bloques de filas en la cola si workers > 1
+    sketches:
+        si True actualiza los resúmenes de cuantiles de la tabla sketches
+        (ver sketch_quim_chs) con las filas nuevas de analisis; los valores
+        nuevos fuera de los límites [(Q1-k IQR), (Q3+k IQR)] del resumen
+        anterior se graban en la tabla outliers_new si el grupo tiene al
+        menos SKETCH_MIN_N valores. Con staged los resúmenes se rehacen al
+        final a partir de analisis
+    k:
+        factor del IQR si sketches es True
+    target:
+        'sqlite' o 'postgres'; con 'postgres' db es la db de con_get y las
+        tablas están en el esquema PG_SCHEMA (ver insert_pg); bulk,
+        batch_size, staged, sketches y k sólo se usan con sqlite
     Returns
         None
     """
-
-    select_puntos = """
-    select *
-    from puntos
-    where fid = ?
-    """
+    if target == 'postgres':
+        insert_pg(csvfiles, csvpath, db, sep, exception, insert_update,
+                  workers, queue_size)
+        return
+    elif target != 'sqlite':
+        raise ValueError(f'target {target} is not valid')
 
     insert_puntos = """
     insert into puntos(fid, xetrs89, yetrs89, id_mas, tm, prov,
@@ -114,34 +506,16 @@ def insert(csvfiles: list, csvpath: str, db: str,
     values (?, ?, ?, ?, ?, ?, ?, ?, ?)
     """
 
-    select_masub = """
-    select *
-    from masub
-    where fid = ?
-    """
-
     insert_masub = """
     insert into masub(fid, name)
     values (?, ?)
     """
 
-    select_param = """
-    select *
-    from param
-    where fid = ?
-    """
-
     insert_param = """
     insert into param(fid, name)
     values (?, ?)
     """
 
-    select_uh = """
-    select *
-    from uh
-    where fid = ?
-    """
-
     insert_uh = """
     insert into uh(fid, name)
     values (?, ?)
@@ -158,117 +532,187 @@ def insert(csvfiles: list, csvpath: str, db: str,
     values (?, ?, ?, ?, ?)
     """
 
-    def to_float(col: str, file: str, line: int, col_name: str,
-                 exception: bool, cols_with_null_values: list,
-                 required: bool = True):
+    create_stage = """
+    create table if not exists analisis_stage(
+        fid text,
+        fecha text,
+        param text,
+        valor real,
+        uds text
+    )
+    """
 
-        if col.lower() == 'null':
-            if col_name not in cols_with_null_values.keys():
-                cols_with_null_values[col_name] = 1
-            else:
-                cols_with_null_values[col_name] += 1
+    insert_stage = """
+    insert into analisis_stage(fid, fecha, param, valor, uds)
+    values (?, ?, ?, ?, ?)
+    """
 
-            msg = f'file {file}, line {i:n} {col_name} is null'
-            logging.append(msg, toScreen=False)
-            if required and exception:
-                raise ValueError(msg)
-            return ''
-        else:
-            return float(col.replace(',', '.'))
+    # las claves de las tablas de dimensiones se leen una vez y se
+    # comprueban en memoria; las filas nuevas se escriben al final de cada
+    # fichero
+    dimensions = ('puntos', 'masub', 'param', 'uh')
 
+    def keys_get(cur, table: str) -> set:
+        cur.execute(f'select fid from {table}')
+        return {row[0] for row in cur.fetchall()}
 
-    def to_str(col: str, file: str, line: int, col_name: str,
-               exception: bool, cols_with_null_values: list,
-               required: bool = True):
+    def dimension_add(table: str, row: tuple):
+        if row[0] not in keys[table]:
+            keys[table].add(row[0])
+            new_rows[table].append(row)
 
-        if col.lower() == 'null':
-            if col_name not in cols_with_null_values.keys():
-                cols_with_null_values[col_name] = 1
-            else:
-                cols_with_null_values[col_name] += 1
+    # en el modo bulk las filas que ya existen se ignoran por su primary key
+    bulk_inserts = {'puntos': insert_puntos, 'masub': insert_masub,
+                    'param': insert_param, 'uh': insert_uh,
+                    'analisis': insert_analisis,
+                    'analisis_stage': insert_stage}
+    bulk_inserts = {table: command.replace('insert into',
+                                           'insert or ignore into')
+                    for table, command in bulk_inserts.items()}
 
-            msg = f'file {file}, line {i:n} {col_name} is null'
-            logging.append(msg, toScreen=False)
-            if required and exception:
-                raise ValueError(msg)
-            return ''
-        else:
-            return col
+    def bulk_write(cur, batches: dict):
+        for table, rows in batches.items():
+            if rows:
+                cur.executemany(bulk_inserts[table], rows)
+                rows.clear()
+
+    def fact_write(cur):
+        if sketches and not staged:
+            sketches_update(cur, analisis_new_get(cur, batches[fact]))
+        bulk_write(cur, batches)
+
+    def analisis_new_get(cur, rows: list) -> list:
+        """
+        Filas de rows cuya clave no está en analisis; de las filas con la
+        misma clave la primera
+        """
+        unique = {}
+        for row in rows:
+            unique.setdefault(row[0:3], row)
+        cur.execute('delete from temp.batch_keys')
+        cur.executemany('insert into temp.batch_keys(fid, fecha, param) '
+                        'values (?, ?, ?)', unique.keys())
+        cur.execute("""
+            select b.fid, b.fecha, b.param
+            from temp.batch_keys b
+                join analisis a on a.fid = b.fid and a.fecha = b.fecha and
+                    a.param = b.param
+            """)
+        existing = set(cur.fetchall())
+        return [row for key, row in unique.items() if key not in existing]
+
+    # resúmenes de cuantiles modificados y valores nuevos fuera de límites
+    sketch_cache = {}
+    flagged = []
+
+    def sketches_update(cur, rows: list):
+        groups = {}
+        for fid, fecha, param, valor, uds in rows:
+            if valor is not None:
+                groups.setdefault((fid, param), []).append((fecha, valor))
+        for key, items in groups.items():
+            if key not in sketch_cache:
+                sketch_cache[key] = sketch_get(cur, *key)
+            sketch = sketch_cache[key]
+            values = np.array([item[1] for item in items])
+            if sketch.n >= SKETCH_MIN_N:
+                lower, upper = sketch.bounds(k)[3:]
+                out = (values < lower) | (values > upper)
+                flagged.extend((key[0], fecha, key[1], valor, lower, upper)
+                               for (fecha, valor), out1 in zip(items, out)
+                               if out1)
+            sketch.update(values)
+
+    def sketches_flush(cur):
+        sketches_write(cur, sketch_cache)
+        sketch_cache.clear()
+        cur.executemany("""
+            insert or replace into outliers_new(fid, fecha, param, valor,
+                lower, upper)
+            values (?, ?, ?, ?, ?, ?)
+            """, flagged)
+        flagged.clear()
 
     cols_with_null_values = {}
+    new_rows = {table: [] for table in dimensions}
+    chunks = chunks_get(csvfiles, csvpath, sep, exception,
+                        cols_with_null_values, workers, queue_size)
+    old_pragmas = None
 
     try:
         connected = False
         con = sqlite3.connect(db)
         connected = True
         cur = con.cursor()
-        for file in csvfiles:
-            print(file)
-            with open(join(csvpath, file), 'r', encoding='utf-8') as fi:
-                csv_reader = csv.reader(fi, delimiter=sep)
-                for i, row in enumerate(csv_reader):
-                    if i == 0:
-                        continue
-                    col = row
-                    for j in range(len(col)):
-                        if j == 0:
-                            col[j] = to_str(col[j], file, i, 'fid analisis', exception, cols_with_null_values)
-                        elif j == 1:
-                            col[j] = to_str(col[j], file, i, 'fecha', exception, cols_with_null_values)
-                        elif j == 2:
-                            col[j] = to_str(col[j], file, i, 'fid param', exception, cols_with_null_values)
-                        elif j == 3:
-                            col[j] = to_str(col[j], file, i, 'param', exception, cols_with_null_values)
-                        elif j == 4:
-                            col[j] = to_str(col[j], file, i, 'uds', exception, cols_with_null_values, False)
-                        elif j == 5:
-                            col[j] = to_float(col[j], file, i, 'valor', exception, cols_with_null_values)
-                        elif j == 6:
-                            col[j] = to_float(col[j], file, i, 'xetrs89', exception, cols_with_null_values)
-                        elif j == 7:
-                            col[j] = to_float(col[j], file, i, 'yetrs89', exception, cols_with_null_values)
-                        elif j == 8:
-                            col[j] = to_str(col[j], file, i, 'id_mas', exception, cols_with_null_values)
-                        elif j == 9:
-                            col[j] = to_str(col[j], file, i, 'mas name', exception, cols_with_null_values, False)
-                        elif j == 10:
-                            col[j] = to_str(col[j], file, i, 'tm', exception, cols_with_null_values, False)
-                        elif j == 11:
-                            col[j] = to_str(col[j], file, i, 'prov', exception, cols_with_null_values, False)
-                        elif j == 12:
-                            col[j] = to_str(col[j], file, i, 'id_uh', exception, cols_with_null_values)
-                        elif j == 13:
-                            col[j] = to_str(col[j], file, i, 'uh name', exception, cols_with_null_values, False)
-                        elif j == 14:
-                            col[j] = to_str(col[j], file, i, 'acu', exception, cols_with_null_values, False)
-                        elif j == 15:
-                            col[j] = to_float(col[j], file, i, 'prof', exception, cols_with_null_values, False)
-
-                    if not insert_update:
-                        continue
-
-                    cur.execute(select_puntos, (col[0],))
-                    if cur.fetchone() is None:
-                        cur.execute(insert_puntos, (col[0], col[6], col[7],
-                                                    col[8], col[10], col[11],
-                                                    col[12], col[14], col[15]))
-
-                    cur.execute(select_masub, (col[8],))
-                    if cur.fetchone() is None:
-                        cur.execute(insert_masub, (col[8], col[9]))
-
-                    cur.execute(select_param, (col[2],))
-                    if cur.fetchone() is None:
-                        cur.execute(insert_param, (col[2], col[3]))
-
-                    cur.execute(select_uh, (col[12],))
-                    if cur.fetchone() is None:
-                        cur.execute(insert_uh, (col[12], col[13]))
-
-                    cur.execute(select_analisis, (col[0], col[1], col[2]))
-                    if cur.fetchone() is None:
-                       cur.execute(insert_analisis, (col[0], col[1], col[2],
-                                                     col[5], col[4]))
+        if staged:
+            cur.execute('select exists(select 1 from analisis)')
+            if cur.fetchone()[0]:
+                logging.append('analisis is not empty, staged is ignored')
+                staged = False
+            else:
+                bulk = True
+        if bulk:
+            old_pragmas = pragmas_set(con, BULK_PRAGMAS)
+        if staged:
+            cur.execute(create_stage)
+            cur.execute('delete from analisis_stage')
+        if sketches:
+            cur.execute(create_sketches)
+            cur.execute(create_outliers_new)
+            cur.execute("""
+                create temp table if not exists batch_keys(
+                    fid text,
+                    fecha text,
+                    param text
+                )
+                """)
+            # db con datos anteriores a los resúmenes: se parte de toda la
+            # tabla analisis, no de un resumen vacío
+            cur.execute('select exists(select 1 from sketches)')
+            if not cur.fetchone()[0]:
+                cur.execute('select exists(select 1 from analisis)')
+                if cur.fetchone()[0]:
+                    sketches_build(cur)
+        fact = 'analisis_stage' if staged else 'analisis'
+        batches = {fact: []}
+        keys = {table: keys_get(cur, table) for table in dimensions}
+        for file, c in chunks:
+            if c is None:
+                # fin del fichero
+                bulk_write(cur, new_rows)
+                if bulk:
+                    fact_write(cur)
+                if sketches and not staged:
+                    sketches_flush(cur)
+                con.commit()
+                continue
+            if not insert_update:
+                continue
+
+            for table, rows in dimension_rows_get(c).items():
+                for row in rows:
+                    dimension_add(table, row)
+
+            rows = analisis_rows_get(c)
+            if bulk:
+                batches[fact] += rows
+                if len(batches[fact]) >= batch_size:
+                    fact_write(cur)
+                continue
+
+            inserted = []
+            for row in rows:
+                cur.execute(select_analisis, row[0:3])
+                if cur.fetchone() is None:
+                    cur.execute(insert_analisis, row)
+                    inserted.append(row)
+            if sketches:
+                sketches_update(cur, inserted)
+
+        if staged:
+            analisis_stage_merge(cur)
+            if sketches:
+                sketches_build(cur)
 
         print('\ncols with null values')
         print('column, null values number')
@@ -280,26 +724,316 @@ def insert(csvfiles: list, csvpath: str, db: str,
     except ValueError:
         msg = traceback.format_exc()
         logging.append(f'ValueError exception\n{msg}')
+        # las filas de dimensiones del fichero leídas antes del error
+        if connected:
+            bulk_write(cur, new_rows)
+            if staged:
+                bulk_write(cur, batches)
+                analisis_stage_merge(cur)
+                if sketches:
+                    sketches_build(cur)
+            elif sketches:
+                sketches_flush(cur)
     finally:
+        chunks.close()
         if connected:
             con.commit()
+            if old_pragmas is not None:
+                pragmas_set(con, old_pragmas)
             con.close()
 
 
-def ooutliers(dbname: str):
+def _copy_value(value) -> str:
+    # formato text de copy de postgres
+    if value is None:
+        return '\\N'
+    if isinstance(value, float):
+        return repr(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def pg_copy_merge(cur, table: str, rows: list) -> int:
+    """
+    Copia rows a la tabla temporal tmp_table y las inserta en
+    PG_SCHEMA.table con una sola sentencia; las filas cuya clave ya existe
+    se ignoran y de las filas con la misma clave se inserta la primera
+
+    Returns
+    -------
+    int
+        número de filas insertadas
+
+    """
+    if not rows:
+        return 0
+    columns = ', '.join(TABLE_COLUMNS[table])
+    keys = ', '.join(TABLE_KEYS[table])
+    buf = StringIO()
+    for row in rows:
+        buf.write('\t'.join(_copy_value(value) for value in row) + '\n')
+    buf.seek(0)
+    cur.copy_expert(f'copy tmp_{table}({columns}) from stdin', buf)
+    cur.execute(f"""
+        insert into {PG_SCHEMA}.{table}({columns})
+        select distinct on ({keys}) {columns}
+        from tmp_{table}
+        order by {keys}, ord
+        on conflict ({keys}) do nothing
+        """)
+    inserted = cur.rowcount
+    cur.execute(f'truncate tmp_{table}')
+    return inserted
+
+
+def insert_pg(csvfiles: list, csvpath: str, db: str, sep: str = ';',
+              exception: bool = True, insert_update: bool = True,
+              workers: int = 1, queue_size: int = 16) -> None:
+    """
+    insert en postgres (target='postgres'): los ficheros se leen y
+    convierten igual que en insert; las filas de analisis de cada bloque
+    se copian con copy y se insertan con pg_copy_merge; las filas nuevas
+    de las tablas de dimensiones se comprueban en memoria y se insertan
+    igual al final de cada fichero, y se hace un commit. Las filas que ya
+    existen no se modifican, como en sqlite
+
+    Parameters
+    ----------
+    db : str
+        db de con_get('postgres', db)
+    El resto como en insert
+
+    Returns
+        None
+    """
+    from db_connection import con_get
+
+    cols_with_null_values = {}
+    con = None
+    chunks = chunks_get(csvfiles, csvpath, sep, exception,
+                        cols_with_null_values, workers, queue_size)
+    new_rows = {table: [] for table in TABLE_COLUMNS if table != 'analisis'}
+
+    def dimensions_write(cur):
+        for table, rows in new_rows.items():
+            pg_copy_merge(cur, table, rows)
+            rows.clear()
+
+    try:
+        con = con_get('postgres', db)
+        cur = con.cursor()
+        keys = {}
+        for table in TABLE_COLUMNS:
+            cur.execute(f'create temp table tmp_{table} '
+                        f'(like {PG_SCHEMA}.{table})')
+            # orden de llegada de las filas
+            cur.execute(f'alter table tmp_{table} add column ord bigserial')
+            if table in new_rows:
+                cur.execute(f'select fid from {PG_SCHEMA}.{table}')
+                keys[table] = {row[0] for row in cur.fetchall()}
+
+        inserted = 0
+        for file, c in chunks:
+            if c is None:
+                # fin del fichero
+                dimensions_write(cur)
+                con.commit()
+                continue
+            if not insert_update:
+                continue
+
+            for table, rows in dimension_rows_get(c).items():
+                for row in rows:
+                    if row[0] not in keys[table]:
+                        keys[table].add(row[0])
+                        new_rows[table].append(row)
+            inserted += pg_copy_merge(cur, 'analisis', analisis_rows_get(c))
+
+        print('\ncols with null values')
+        print('column, null values number')
+        for key, value in cols_with_null_values.items():
+            print(f'{key}, {value}')
+        print(f'{inserted:n} rows inserted in {PG_SCHEMA}.analisis')
+
+    except ValueError:
+        msg = traceback.format_exc()
+        logging.append(f'ValueError exception\n{msg}')
+        # las filas de dimensiones del fichero leídas antes del error
+        if con is not None:
+            dimensions_write(cur)
+            con.commit()
+    except Exception:
+        if con is not None:
+            con.rollback()
+        raise
+    finally:
+        chunks.close()
+        if con is not None:
+            con.close()
+
+
+def iqr_bounds(fids: np.ndarray, params: np.ndarray, values: np.ndarray,
+               k: float = 1.5):
+    """
+    Cuartiles y límites [(Q1 - k IQR), (Q3 + k IQR)] de los valores de cada
+    grupo (fid, param), calculados a la vez para todos los grupos; los
+    cuartiles se interpolan linealmente como en np.percentile
+
+    Parameters
+    ----------
+    fids : np.ndarray
+        fid de cada valor
+    params : np.ndarray
+        param de cada valor
+    values : np.ndarray
+        valores
+    k : float
+        factor del IQR
+
+    Returns
+    -------
+    bounds : list
+        [(fid, param, n, q1, q3, iqr, lower, upper)] ordenada por fid, param
+    group : np.ndarray
+        índice en bounds del grupo de cada valor
+    lower, upper : np.ndarray
+        límites del grupo de cada valor
+
+    """
+    # cada columna se factoriza por separado y los índices se combinan en
+    # una clave entera, que se ordena como (fid, param)
+    ufids, ifids = np.unique(fids, return_inverse=True)
+    uparams, iparams = np.unique(params, return_inverse=True)
+    keys = ifids.reshape(-1).astype(np.int64) * uparams.size + \
+        iparams.reshape(-1)
+    _, first, group, n = np.unique(keys, return_index=True,
+                                   return_inverse=True, return_counts=True)
+    group = group.reshape(-1)
+    order = np.lexsort((values, group))
+    sorted_values = values[order]
+    starts = np.concatenate(([0], np.cumsum(n)[:-1]))
+
+    def quantile(p: float) -> np.ndarray:
+        pos = (n - 1) * p
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        vlo = sorted_values[starts + lo]
+        vhi = sorted_values[starts + hi]
+        return vlo + (vhi - vlo) * (pos - lo)
+
+    q1 = quantile(0.25)
+    q3 = quantile(0.75)
+    iqr = q3 - q1
+    glower = q1 - k * iqr
+    gupper = q3 + k * iqr
+    bounds = list(zip(fids[first].tolist(), params[first].tolist(),
+                      n.tolist(), q1.tolist(), q3.tolist(), iqr.tolist(),
+                      glower.tolist(), gupper.tolist()))
+    return bounds, group, glower[group], gupper[group]
+
+
+def fid_shards_get(cur, nshards: int) -> list:
+    """
+    Divide los fid de analisis en nshards rangos consecutivos
+    [fid_min, fid_max] con un número de filas parecido; todos los valores
+    de un grupo (fid, param) quedan en el mismo rango
+    """
+    cur.execute("""
+        select fid, count(*)
+        from analisis
+        group by fid
+        order by fid
+        """)
+    rows = cur.fetchall()
+    if not rows:
+        return []
+    total = sum(row[1] for row in rows)
+    shards = []
+    fid_min, acc = rows[0][0], 0
+    for i, (fid, n) in enumerate(rows):
+        acc += n
+        if acc >= total * (len(shards) + 1) / nshards or i == len(rows) - 1:
+            shards.append((fid_min, fid))
+            if i < len(rows) - 1:
+                fid_min = rows[i + 1][0]
+    return shards
+
+
+def outliers_shard(dbname: str, fid_min: str, fid_max: str,
+                   k: float = 1.5):
+    """
+    Límites y outliers de los grupos (fid, param) con fid en
+    [fid_min, fid_max]; si son None todos. La db se abre en solo lectura,
+    de modo que se puede llamar desde varios procesos a la vez
+
+    Returns
+    -------
+    bounds : list
+        filas de outliers_bounds
+    outliers : list
+        filas de outliers
+
+    """
+    select_analisis = """
+    select fid, param, fecha, valor
+    from analisis
+    where typeof(valor) in ('real', 'integer')
+    """
+    args = ()
+    if fid_min is not None:
+        select_analisis += ' and fid >= ? and fid <= ?'
+        args = (fid_min, fid_max)
+
+    uri = 'file:' + pathname2url(abspath(dbname)) + '?mode=ro'
+    con = sqlite3.connect(uri, uri=True)
+    try:
+        rows = con.execute(select_analisis, args).fetchall()
+    finally:
+        con.close()
+    if not rows:
+        return [], []
+
+    fids, params, fechas, values = zip(*rows)
+    del rows
+    fids = np.array(fids, dtype=object)
+    params = np.array(params, dtype=object)
+    fechas = np.array(fechas, dtype=object)
+    values = np.array(values, dtype=np.float64)
+
+    bounds, _, lower, upper = iqr_bounds(fids, params, values, k)
+    out = (values < lower) | (values > upper)
+    outliers = list(zip(fids[out].tolist(), fechas[out].tolist(),
+                        params[out].tolist(), values[out].tolist(),
+                        lower[out].tolist(), upper[out].tolist()))
+    return bounds, outliers
+
+
+def ooutliers(dbname: str, k: float = 1.5, workers: int = 1):
     """
     IQR diferencia entre el tercer y el primer cuartil
     [(Q1-1.5 IQR), (Q3+1.5 IQR)]
 
+    La tabla analisis se lee una vez y los límites de todos los grupos
+    (fid, param) se calculan a la vez (iqr_bounds). Los límites se graban
+    en la tabla outliers_bounds y las filas fuera de ellos en la tabla
+    outliers; ambas se vacían antes de grabar. Con workers > 1 los fid se
+    dividen en rangos que se calculan en procesos distintos, cada uno con
+    su conexión de solo lectura; el resultado es el mismo que con un
+    proceso
+
     Parameters
     ----------
     dbname : str
-        DESCRIPTION.
+        db sqlite con la tabla analisis
+    k : float
+        factor del IQR; por defecto 1.5
+    workers : int
+        número de procesos; por defecto 1
 
     Raises
     ------
     ValueError
-        DESCRIPTION.
+        error de sqlite
 
     Returns
     -------
@@ -307,51 +1041,73 @@ def ooutliers(dbname: str):
 
     """
 
-    select_puntos = """
-    select fid
-    from puntos
-    order by fid;
+    create_bounds = """
+    create table if not exists outliers_bounds(
+        fid text,
+        param text,
+        n integer,
+        q1 real,
+        q3 real,
+        iqr real,
+        lower real,
+        upper real,
+        primary key (fid, param)
+    )
     """
 
-    select_params = """
-    select fid
-    from param
-    order by fid
-    ;
+    create_outliers = """
+    create table if not exists outliers(
+        fid text,
+        fecha text,
+        param text,
+        valor real,
+        lower real,
+        upper real,
+        primary key (fid, fecha, param)
+    )
     """
 
-    select_analisis = """
-    select valor
-    from analisis
-    where fid=? and param = ?
-    order by valor;
+    insert_bounds = """
+    insert into outliers_bounds(fid, param, n, q1, q3, iqr, lower, upper)
+    values (?, ?, ?, ?, ?, ?, ?, ?)
+    """
+
+    insert_outliers = """
+    insert into outliers(fid, fecha, param, valor, lower, upper)
+    values (?, ?, ?, ?, ?, ?)
     """
 
     try:
+        connected = False
         con = sqlite3.connect(dbname)
+        connected = True
         cur = con.cursor()
 
-        cur.execute(select_params)
-        params = cur.fetchall()
-
-        cur.execute(select_puntos)
-        puntos = cur.fetchall()
-
-        perc = np.empty(2, np.float32)
-
-        for punto1 in puntos:
-            print(punto1)
-            for param1 in params:
-                cur.execute(select_analisis, (punto1, param1))
-                values = cur.fetchall()
-                values = np.asarray(values, dtype=np.float32)
-                perc = np.percentile(values, [25, 75])
-
-
+        if workers > 1:
+            shards = fid_shards_get(cur, workers)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(outliers_shard, dbname, fid_min,
+                                           fid_max, k)
+                           for fid_min, fid_max in shards]
+                results = [future.result() for future in futures]
+        else:
+            results = [outliers_shard(dbname, None, None, k)]
 
+        cur.execute(create_bounds)
+        cur.execute(create_outliers)
+        cur.execute('delete from outliers_bounds')
+        cur.execute('delete from outliers')
+        nbounds, noutliers = 0, 0
+        for bounds, outliers in results:
+            cur.executemany(insert_bounds, bounds)
+            cur.executemany(insert_outliers, outliers)
+            nbounds += len(bounds)
+            noutliers += len(outliers)
+        con.commit()
+        print(f'{nbounds:n} groups (fid, param), {noutliers:n} outliers')
 
     except Error:
         raise ValueError(Error)
     finally:
-        con.close()
-
+        if connected:
+            con.close()
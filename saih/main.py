@@ -13,10 +13,12 @@ Asegúrate de si tienes ficheros con distinto delimitador, detect_delim tiene
     valor true
 
 Según el intervalo temporal seleccionado en la pág. web de la CHS, los
-datos tienen intervalo temporal diario u horario, por lo que es
-IMPRESCINDIBLE no mezclar en el mismo directorio de descarga datos con
-discretizaciones temporales diferentes. El resto de información necesaria
-se lee directamente de cada fichero
+datos tienen intervalo temporal diario, horario o minutal. Con tstep = 'auto'
+se detecta el intervalo de cada fichero y se inserta en su tabla (saih.tsd,
+saih.tsh, saih.tsm), por lo que se pueden mezclar en el mismo directorio
+ficheros con discretizaciones temporales diferentes; con otro valor de tstep
+todos los ficheros deben tener ese intervalo. El resto de información
+necesaria se lee directamente de cada fichero
 
 Revisa el encoding de los ficheros descargados, este
 parámetro tiene valores por defecto al formato más reciente de la CHS, pero
@@ -25,8 +27,28 @@ pueden cambiar. En la actualidad file_encoding = 'utf-8-sig'
 
 # ============ parameters =============
 path2files = r'H:\LSGB\data2db\saih\p01_dia'
-tstep = 'day'  # in ('day', 'hour')
+tstep = 'auto'  # in ('auto', 'day', 'hour', 'minute')
 upsert = False
+detect_delim = True  # True: delimiter, decimal and encoding of each file
+db = 'ipa'  # section in pgdb.ini; None: db and credentials are asked
+bulk = True  # True: copy + single merge statement per file
+workers = 4  # processes that read the csv files
+# sqlite db with the files already imported; None to import all the files
+ledger = r'H:\LSGB\data2db\saih\saih_ledger.db'
+changes_only = True  # True: only new or changed values are written
+# None: a commit at the end; 0: a commit by file; n: a commit every n rows
+batch_rows = 100000
+# json file to resume an interrupted run; None: no checkpoint
+checkpoint = r'H:\LSGB\data2db\saih\saih_checkpoint.json'
+daily = False  # True: daily aggregates of the hourly files in saih.tsd
+# parquet copy of the loaded series (requires pyarrow); None: no copy
+parquet = None
+# json with data quality statistics of the loaded series, for instance
+# r'H:\LSGB\data2db\saih\saih_quality.json'; None: no report
+quality = None
+# {first letter of the variable: maximum jump between consecutive values};
+# None: saih_quality.SPIKE_THRESHOLDS
+spike_thresholds = None
 # =====================================
 
 
@@ -45,8 +67,13 @@ if __name__ == "__main__":
 
         startTime = time()
 
-        saih = si.Saih_import(path2files, tstep)
-        saih.upsert_data_from_csv_files(upsert)
+        saih = si.Saih_import(path2files, tstep, detect_delim=detect_delim,
+                              db=db)
+        saih.upsert_data_from_csv_files(upsert, bulk, workers, ledger,
+                                        changes_only, batch_rows, checkpoint,
+                                        daily, parquet=parquet,
+                                        quality=quality,
+                                        spike_thresholds=spike_thresholds)
 
         xtime = time() - startTime
         print(f'El script tardó {xtime:0.1f} s')
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:40:11 2026
+
+@author: solis
+
+Importa de forma continua los ficheros csv del saih que se descargan en
+path2files. El directorio se revisa cada interval segundos y los ficheros
+nuevos o modificados se importan cuando ya no cambian (settle segundos).
+La conexión a la base de datos se lee de pgdb.ini (sección db), por lo que
+no se piden credenciales. El estado del servicio se escribe en heartbeat.
+Para detenerlo pulsa Ctrl+C
+"""
+
+# ============ parameters =============
+path2files = r'H:\LSGB\data2db\saih\descargas'
+pattern = '*'  # csv, zip, tar.gz and gz files
+db = 'ipa'  # section in pgdb.ini
+ledger = r'H:\LSGB\data2db\saih\saih_ledger.db'
+heartbeat = r'H:\LSGB\data2db\saih\saih_watch.json'
+interval = 30.  # seconds between polls
+settle = 10.  # seconds without changes before a file is imported
+queue_size = 100  # maximum files waiting to be imported
+workers = 2  # processes that read the csv files
+loaders = 2  # threads importing at the same time, one connection each
+daily = False  # True: daily aggregates of the hourly files in saih.tsd
+# =====================================
+
+
+if __name__ == "__main__":
+
+    try:
+        import traceback
+        import sys
+
+        import littleLogging as logging
+        from saih_watch import Saih_watch
+
+        watch = Saih_watch(path2files, db, ledger, heartbeat,
+                           pattern=pattern, interval=interval, settle=settle,
+                           queue_size=queue_size, workers=workers,
+                           loaders=loaders, daily=daily)
+        watch.run()
+
+    except ValueError:
+        msg = traceback.format_exc()
+        logging.append(f'ValueError exception\n{msg}')
+    except ImportError:
+        msg = traceback.format_exc()
+        print (f'ImportError exception\n{msg}')
+    except Exception:
+        msg = traceback.format_exc()
+        logging.append(f'Exception\n{msg}')
+    finally:
+        if 'logging' in sys.modules:
+            logging.dump()
+        print('\nFin')
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:40:05 2026
+
+@author: solis
+
+The chs downloads can be csv files or archives with many csv files: .zip,
+.tar.gz (.tgz) or a single compressed file .gz. A source is the name of a
+csv file, of a .gz file or, for a member of a .zip or .tar.gz archive,
+archive + MEMBER_SEP + member name. The members are read directly from
+the archive, without extracting them to disk.
+
+A .tar.gz has no index: finding a member decompresses the whole archive and
+reading it the archive up to the member. So the members of each .tar.gz
+(name, size, mtime) are kept once the archive has been read, and the
+decompressed content of the last .tar.gz read is kept too; a member is read
+from it. An archive is read again only when its size or mtime change.
+"""
+from contextlib import contextmanager
+import gzip
+from io import BytesIO, TextIOWrapper
+from os import stat
+from os.path import abspath
+import tarfile
+import threading
+from time import mktime
+import zipfile
+import zlib
+
+MEMBER_SEP = '::'
+
+# exceptions raised by a corrupt or partially written archive
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError,
+                  zlib.error)
+
+
+_tar_lock = threading.Lock()
+# {archive: ((size, mtime), {member name: TarInfo})}
+_tar_members = {}
+# (archive, (size, mtime), decompressed content) of the last .tar.gz read
+_tar_last = (None, None, None)
+
+
+def _is_tar(fi):
+    return fi.lower().endswith(('.tar.gz', '.tgz'))
+
+
+def _tar_read(fi):
+    """
+    Decompressed content of the .tar.gz fi and its (size, mtime)
+    """
+    global _tar_last
+    path = abspath(fi)
+    st = stat(fi)
+    key = (st.st_size, st.st_mtime)
+    with _tar_lock:
+        if _tar_last[0:2] != (path, key):
+            with gzip.open(fi, 'rb') as f:
+                _tar_last = (path, key, f.read())
+        return _tar_last[1:]
+
+
+def _tar_members_get(fi):
+    """
+    {member name: TarInfo} of the .tar.gz fi
+    """
+    path = abspath(fi)
+    st = stat(fi)
+    with _tar_lock:
+        cached = _tar_members.get(path)
+    if cached is not None and cached[0] == (st.st_size, st.st_mtime):
+        return cached[1]
+    key, data = _tar_read(fi)
+    with tarfile.open(fileobj=BytesIO(data), mode='r:') as t:
+        members = {m.name: m for m in t.getmembers()}
+    with _tar_lock:
+        _tar_members[path] = (key, members)
+    return members
+
+
+def sources_get(file_names):
+    """
+    Replaces the .zip and .tar.gz archives in file_names by their csv
+    members; of the other files only the .csv and .gz files are kept. An
+    archive that can not be read raises one of ARCHIVE_ERRORS
+
+    Parameters
+    ----------
+    file_names : list
+        file names.
+
+    Returns
+    -------
+    list
+        sources.
+
+    """
+    sources = []
+    for fi in file_names:
+        if fi.lower().endswith('.zip'):
+            with zipfile.ZipFile(fi) as z:
+                sources += [fi + MEMBER_SEP + name for name in z.namelist()
+                            if name.lower().endswith('.csv')]
+        elif _is_tar(fi):
+            sources += [fi + MEMBER_SEP + name
+                        for name, m in _tar_members_get(fi).items()
+                        if m.isfile() and name.lower().endswith('.csv')]
+        elif fi.lower().endswith(('.csv', '.gz')):
+            sources.append(fi)
+    return sources
+
+
+@contextmanager
+def open_source(source, encoding=None):
+    """
+    Opens a source; with encoding=None the stream is binary, else it is
+    text (newline='' as required by the csv module)
+    """
+    fi, _, member = source.partition(MEMBER_SEP)
+    archive = None
+    if member and _is_tar(fi):
+        info = _tar_members_get(fi)[member]
+        _, data = _tar_read(fi)
+        archive = tarfile.open(fileobj=BytesIO(data), mode='r:')
+        f = archive.extractfile(info)
+    elif member:
+        archive = zipfile.ZipFile(fi)
+        f = archive.open(member)
+    elif fi.lower().endswith('.gz'):
+        f = gzip.open(fi, 'rb')
+    else:
+        f = open(fi, 'rb')
+    try:
+        if encoding is None:
+            yield f
+        else:
+            yield TextIOWrapper(f, encoding=encoding, newline='')
+    finally:
+        f.close()
+        if archive is not None:
+            archive.close()
+
+
+def source_stat(source):
+    """
+    Size and modification time of a source; for an archive member they are
+    the ones stored in the archive
+
+    Returns
+    -------
+    tuple
+        (size, mtime)
+
+    """
+    fi, _, member = source.partition(MEMBER_SEP)
+    if member and _is_tar(fi):
+        m = _tar_members_get(fi)[member]
+        return m.size, float(m.mtime)
+    elif member:
+        with zipfile.ZipFile(fi) as z:
+            info = z.getinfo(member)
+            return info.file_size, mktime(info.date_time + (0, 0, -1))
+    st = stat(fi)
+    return st.st_size, st.st_mtime
@@ -5,7 +5,7 @@ Created on Sun May  1 11:47:47 2022
 @author: solis
 
 Data are imported into a table from csv files downloaded from the chs website.
-The destination table can be: saih.tsd, saih.tsh or another
+The destination table can be: saih.tsd, saih.tsh, saih.tsm or another
 table with the same structure and primary key as the previous ones.
 
 The date format of the downloaded data is %y-%m-%d HH:MM:ss. Depending on the
@@ -13,20 +13,589 @@ time interval selected when downloading the data, the content varies: If the
 data are daily the content is %y-%m-%d 00:00:00:00; if the data are hourly
 %y-%m-%d HH:00:00:00; if minute %y-%m-%d HH:MM:00
 
-It is important that in an operation to load data into the database, the
-selected directory does not have files of different temporal discrimination:
-daily, hourly, hourly, etc.
+The files can also be .zip, .tar.gz or .gz archives of csv files; their
+members are read directly from the archive (see saih_archives).
+
+With tstep 'auto' the time step of each file is detected from its dates and
+the file is loaded in the table of its time step (TABLES), so a directory
+can have files of different temporal discrimination: daily, hourly, minute.
+With tstep 'day', 'hour' or 'minute' all the files must have that time step.
 
 """
+import codecs
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import csv
-from datetime import datetime, date
 import glob
+from io import StringIO
+from itertools import islice
+import json
+import numpy as np
 from pathlib import Path
 import psycopg2
-from os.path import join
+from os import remove, replace
+from os.path import abspath, exists, join
 import traceback
 
 import littleLogging as logging
+from saih_archives import ARCHIVE_ERRORS, open_source, source_stat, \
+    sources_get
+from saih_ledger import file_fingerprint, Saih_ledger
+from saih_pool import pool_get
+
+# time step: (table, primary key constraint, numpy datetime64 unit)
+# saih.tsm has the same structure and primary key as saih.tsh; it is created
+# with saih_tables.sql
+TABLES = {'day': ('saih.tsd', 'tsd_pkey', 'D'),
+          'hour': ('saih.tsh', 'tsh_pkey', 'h'),
+          'minute': ('saih.tsm', 'tsm_pkey', 'm')}
+
+# daily aggregate of the hourly values by the first letter of the variable
+# code: 'mean', 'sum' or 'max'; the variables not in the dict are 'mean'
+DAILY_AGGREGATES = {'p': 'sum'}
+
+# maximum number of lines listed in the message of the values of a file
+# that are not a number; the message always has the total number
+MAX_WRONG_LINES = 10
+
+# characters of a number once the decimal separator is '.'
+NUMBER_CHARS = '0123456789+-.eE'
+_NOT_NUMBER = str.maketrans('', '', NUMBER_CHARS)
+
+
+def dates_parse(strdates, lines, tstep, fi):
+    """
+    Converts the column of dates of a file in one pass and checks that all
+    of them agree with tstep; if tstep is 'auto', the time step is the
+    largest of TABLES that all the dates agree with
+
+    Parameters
+    ----------
+    strdates : list
+        dates as str with format %Y-%m-%d %H:%M:%S.
+    lines : list
+        line in fi of each element in strdates.
+    tstep : str
+        date-time step: must be: ('auto', 'day', 'hour', 'minute')
+    fi : str
+        File of strdates.
+
+    Raises
+    ------
+    ValueError
+        Not valid dates or dates with a time step different from tstep; the
+        message has all the wrong lines.
+
+    Returns
+    -------
+    str
+        time step of the dates.
+    list
+        date (tstep 'day') or datetime of each strdates.
+
+    """
+    if tstep != 'auto' and tstep not in TABLES:
+        msg = f'tstep {tstep} is not valid'
+        raise ValueError(msg)
+
+    lines = np.asarray(lines)
+    try:
+        dt = np.array(strdates, dtype='datetime64[s]')
+    except ValueError:
+        # slow path, only to find all the wrong lines
+        wrong = []
+        for strdate, line in zip(strdates, lines):
+            try:
+                np.datetime64(strdate, 's')
+            except ValueError:
+                wrong.append(str(line))
+        msg = f'Not valid dates in {fi}, lines {", ".join(wrong)}'
+        raise ValueError(msg)
+
+    if tstep == 'auto':
+        for tstep1, (_, _, unit) in TABLES.items():
+            if np.all(dt == dt.astype(f'datetime64[{unit}]')):
+                tstep = tstep1
+                break
+        else:
+            msg = f'The time step of {fi} is not any of {", ".join(TABLES)}'
+            raise ValueError(msg)
+
+    dt_step = dt.astype(f'datetime64[{TABLES[tstep][2]}]')
+    wrong = lines[dt != dt_step]
+    if wrong.size > 0:
+        msg = f'Time step must be {tstep}s in {fi}, lines ' + \
+            ', '.join(str(line) for line in wrong)
+        raise ValueError(msg)
+
+    if tstep == 'day':
+        return tstep, dt_step.tolist()
+    else:
+        return tstep, dt_step.astype('datetime64[s]').tolist()
+
+
+def decimal_get(delim):
+    """
+    Decimal separator of the chs csv files: the current files have ';' as
+    delimiter and ',' as decimal separator, the older ones ',' and '.'
+    """
+    if delim == ',':
+        return '.'
+    return ','
+
+
+def dialect_detect(fi, read_chunk=5000):
+    """
+    Detects the encoding, delimiter and decimal separator of a csv file
+    reading only its first read_chunk bytes
+
+    Parameters
+    ----------
+    fi : str
+        csv file or archive member (see saih_archives).
+    read_chunk : int, optional
+        bytes read. The default is 5000.
+
+    Returns
+    -------
+    tuple
+        (delim, decimal, encoding)
+
+    """
+    with open_source(fi) as f:
+        chunk = f.read(read_chunk)
+    if chunk.startswith(codecs.BOM_UTF8):
+        encoding = 'utf-8-sig'
+    else:
+        encoding = 'utf-8'
+    try:
+        # the chunk can end in the middle of a character
+        text = codecs.getincrementaldecoder(encoding)().decode(chunk)
+    except UnicodeDecodeError:
+        encoding = 'cp1252'
+        text = chunk.decode(encoding, errors='replace')
+    try:
+        delim = csv.Sniffer().sniff(text, delimiters=';,\t').delimiter
+    except csv.Error:
+        delim = ';'
+    return delim, decimal_get(delim), encoding
+
+
+def values_parse(strvalues, decimal=','):
+    """
+    Converts a column of values to float without raising an exception for
+    each value that is not a number
+
+    Parameters
+    ----------
+    strvalues : list
+        values as str.
+    decimal : str, optional
+        decimal separator. The default is ','.
+
+    Returns
+    -------
+    values : ndarray
+        float64 values; nan where the value is not a number.
+    valid : ndarray
+        bool mask, False where the value is not a number.
+
+    """
+    if len(strvalues) == 0:
+        return np.empty(0), np.empty(0, dtype=bool)
+    a = np.char.strip(np.asarray(strvalues, dtype=str))
+    if decimal != '.':
+        a = np.char.replace(a, decimal, '.')
+    # a number has only NUMBER_CHARS and at least one digit
+    not_number_chars = np.char.str_len(np.char.translate(a, _NOT_NUMBER))
+    has_digit = np.zeros(a.shape, dtype=bool)
+    for digit in '0123456789':
+        has_digit |= np.char.find(a, digit) >= 0
+    valid = (not_number_chars == 0) & has_digit
+
+    values = np.full(a.shape, np.nan)
+    try:
+        values[valid] = a[valid].astype(np.float64)
+    except ValueError:
+        # slow path, only for strings like 1.2.3 or 1-2
+        for i in np.flatnonzero(valid):
+            try:
+                values[i] = float(a[i])
+            except ValueError:
+                valid[i] = False
+    return values, valid
+
+
+def read_csv_file(fi, tstep, file_encoding, delim, decimal=None):
+    """
+    Reads a csv file downloaded from the chs website. It is a module
+    function so that it can be run in a worker process
+
+    Parameters
+    ----------
+    fi : str
+        csv file or archive member (see saih_archives).
+    tstep : str
+        date-time step: must be: ('auto', 'day', 'hour', 'minute')
+    file_encoding : str
+        encoding of fi
+    delim : str
+        delimiter of fi columns
+    decimal : str, optional
+        decimal separator of the values; if None it is decimal_get(delim).
+        The default is None.
+
+    Raises
+    ------
+    ValueError
+        Dates with a time step different from tstep.
+
+    Returns
+    -------
+    tstep : str
+        time step of the file.
+    id1 : str
+        station code.
+    var : str
+        variable code.
+    rows : dict
+        {date or datetime: value}
+    msgs : list
+        message with the number of values that are not a number and the
+        first MAX_WRONG_LINES lines of them, if any; it is returned because
+        the logging of a worker process is not dumped
+
+    """
+    id1 = var = None
+    lines = []
+    strdates = []
+    strvalues = []
+    with open_source(fi, file_encoding) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=delim)
+        for line, row in enumerate(csv_reader):
+            if line == 0:
+                id1 = row[1][0:5].lower()
+                var = row[1][5:8].lower()
+                continue
+            if not row:
+                continue
+            lines.append(line)
+            strdates.append(row[0])
+            strvalues.append(row[1])
+
+    tstep, dates = dates_parse(strdates, lines, tstep, fi)
+
+    if decimal is None:
+        decimal = decimal_get(delim)
+    values, valid = values_parse(strvalues, decimal)
+    rows = {d: x for d, x, ok in zip(dates, values.tolist(), valid) if ok}
+
+    msgs = []
+    if not valid.all():
+        wrong = np.flatnonzero(~valid)
+        rejects = sorted({strvalues[i] for i in wrong})
+        wrong_lines = ', '.join(str(lines[i])
+                                for i in wrong[:MAX_WRONG_LINES])
+        if wrong.size > MAX_WRONG_LINES:
+            wrong_lines += ', ...'
+        msgs.append(f'{fi}, {wrong.size:d} values are not a number '
+                    f'({", ".join(repr(x) for x in rejects[:10])}) in lines '
+                    + wrong_lines)
+    return tstep, id1, var, rows, msgs
+
+
+def changed_rows_get(rows, existing, upsert):
+    """
+    Compares the rows of a file with the rows already in the database
+
+    Parameters
+    ----------
+    rows : dict
+        {date or datetime: value} of the file.
+    existing : list
+        [(date or datetime, value)] in the database for the station and
+        variable of rows in the range of dates of rows, ordered by date.
+    upsert : bool
+        If False only new dates are returned; if True dates whose value has
+        changed are returned too.
+
+    Returns
+    -------
+    dict
+        {date or datetime: value} new or changed.
+    int
+        number of rows of the file that are not returned.
+
+    """
+    if not rows or not existing:
+        return rows, 0
+    dates = np.array(list(rows.keys()), dtype='datetime64[s]')
+    values = np.array(list(rows.values()), dtype=np.float64)
+    edates = np.array([row[0] for row in existing], dtype='datetime64[s]')
+    evalues = np.array([row[1] for row in existing], dtype=np.float64)
+
+    idx = np.searchsorted(edates, dates)
+    idx[idx == edates.size] = 0
+    found = edates[idx] == dates
+    if upsert:
+        to_write = ~found | (evalues[idx] != values)
+    else:
+        to_write = ~found
+    keys = list(rows.keys())
+    changed = {keys[i]: rows[keys[i]] for i in np.flatnonzero(to_write)}
+    return changed, len(rows) - len(changed)
+
+
+def daily_aggregates_get(rows, how):
+    """
+    Daily aggregates of the hourly values of a file
+
+    Parameters
+    ----------
+    rows : dict
+        {datetime: value} hourly values.
+    how : str
+        'mean', 'sum' or 'max'
+
+    Raises
+    ------
+    ValueError
+        how is not valid.
+
+    Returns
+    -------
+    dict
+        {date: aggregate} of the days with the 24 hourly values.
+    set
+        days with less than 24 hourly values; they are not aggregated.
+
+    """
+    if how not in ('mean', 'sum', 'max'):
+        raise ValueError(f'{how} is not a valid daily aggregate')
+    if not rows:
+        return {}, set()
+    days = np.array(list(rows.keys()), dtype='datetime64[h]') \
+        .astype('datetime64[D]')
+    values = np.array(list(rows.values()), dtype=np.float64)
+    order = np.argsort(days, kind='stable')
+    days = days[order]
+    values = values[order]
+    udays, start, counts = np.unique(days, return_index=True,
+                                     return_counts=True)
+    if how == 'max':
+        agg = np.maximum.reduceat(values, start)
+    else:
+        agg = np.add.reduceat(values, start)
+        if how == 'mean':
+            agg = agg / counts
+    complete = counts == 24
+    return dict(zip(udays[complete].tolist(), agg[complete].tolist())), \
+        set(udays[~complete].tolist())
+
+
+class Saih_table():
+
+    def __init__(self, tstep):
+        """
+        Writer of the rows of a time step in its table; each table has its
+        own statements and temporary table for the bulk load
+
+        Parameters
+        ----------
+        tstep : str
+            date-time step: must be a key of TABLES
+
+        Returns
+        -------
+        None.
+
+        """
+        table, pkey, _ = TABLES[tstep]
+        self.tstep = tstep
+        self.table = table
+        self.pkey = pkey
+        self.columns = None
+        # the statements return (xmax = 0), that is true for an inserted row
+        # and false for an updated one; rows that exist and are not
+        # updated are not returned
+        self.insert = \
+            f"""
+            insert into {self.table} values(%s, %s, %s, %s)
+            on conflict on constraint {self.pkey}
+            do nothing
+            returning (xmax = 0)
+            """
+        self.upsert = \
+            f"""
+            insert into {self.table} as t values(%s, %s, %s, %s)
+            on conflict on constraint {self.pkey}
+            do update set v = excluded.v
+            where t.v is distinct from excluded.v
+            returning (xmax = 0)
+            """
+        # bulk mode: rows are copied into a temporary table with the
+        # same structure as self.table and then merged in a single statement
+        # that returns the rows written (station, date, variable, value)
+        # and (xmax = 0)
+        self.tmp_table = 'tmp_' + table.replace('.', '_')
+        self.bulk_insert = \
+            f"""
+            insert into {self.table}
+            select * from {self.tmp_table}
+            on conflict on constraint {self.pkey}
+            do nothing
+            returning *, (xmax = 0)
+            """
+        self.bulk_upsert = \
+            f"""
+            insert into {self.table} as t
+            select * from {self.tmp_table}
+            on conflict on constraint {self.pkey}
+            do update set v = excluded.v
+            where t.v is distinct from excluded.v
+            returning *, (xmax = 0)
+            """
+
+
+    def columns_get(self, cur):
+        """
+        Names of the columns of self.table: station, date, variable, value
+        """
+        schema, table = self.table.split('.')
+        cur.execute(
+            """
+            select column_name
+            from information_schema.columns
+            where table_schema = %s and table_name = %s
+            order by ordinal_position
+            """, (schema, table))
+        self.columns = [row[0] for row in cur.fetchall()]
+
+
+    def existing_get(self, cur, id1, var, rows):
+        """
+        Rows of self.table for id1 and var in the range of dates of rows,
+        ordered by date
+        """
+        c_id1, c_date, c_var, c_v = self.columns[0:4]
+        cur.execute(
+            f"""
+            select {c_date}, {c_v}
+            from {self.table}
+            where {c_id1} = %s and {c_var} = %s
+                and {c_date} between %s and %s
+            order by {c_date}
+            """, (id1, var, min(rows), max(rows)))
+        return cur.fetchall()
+
+
+    def exists(self, cur) -> bool:
+        cur.execute('select to_regclass(%s)', (self.table,))
+        return cur.fetchone()[0] is not None
+
+
+    def create_tmp_table(self, cur):
+        cur.execute(f'drop table if exists {self.tmp_table}')
+        cur.execute(f'create temp table {self.tmp_table} ' +
+                    f'(like {self.table})')
+
+
+    def bulk_write(self, cur, id1, var, rows, upsert):
+        """
+        Copies the rows of a file into the temporary table and merges them
+        into self.table
+
+        Parameters
+        ----------
+        cur : cursor
+            cursor of the connection.
+        id1 : str
+            station code.
+        var : str
+            variable code.
+        rows : dict
+            {date or datetime: value}; a date appears only once, so the
+            merge never affects the same row twice.
+        upsert : bool
+            If False inserts only new data; is True update values too.
+
+        Returns
+        -------
+        tuple
+            number of rows inserted, updated and unchanged.
+        dict
+            rows of rows inserted or updated.
+
+        """
+        if not rows:
+            return (0, 0, 0), {}
+        buf = StringIO()
+        for d, x in rows.items():
+            buf.write(f'{id1}\t{d}\t{var}\t{x!r}\n')
+        buf.seek(0)
+        cur.copy_expert(f'copy {self.tmp_table} from stdin', buf)
+        if upsert:
+            cur.execute(self.bulk_upsert)
+        else:
+            cur.execute(self.bulk_insert)
+        merged = cur.fetchall()
+        cur.execute(f'truncate {self.tmp_table}')
+        # the dates returned by the database can be of another type than
+        # the keys of rows
+        keys = {np.datetime64(d, 's'): d for d in rows}
+        written = {}
+        inserted = 0
+        for row in merged:
+            d = keys[np.datetime64(row[1], 's')]
+            written[d] = rows[d]
+            if row[-1]:
+                inserted += 1
+        updated = len(merged) - inserted
+        return (inserted, updated, len(rows) - len(merged)), written
+
+
+    def write(self, cur, id1, var, rows, upsert):
+        """
+        Inserts or upserts the rows of a file one by one
+
+        Parameters
+        ----------
+        cur : cursor
+            cursor of the connection.
+        id1 : str
+            station code.
+        var : str
+            variable code.
+        rows : dict
+            {date or datetime: value}
+        upsert : bool
+            If False inserts only new data; is True update values too.
+
+        Returns
+        -------
+        tuple
+            number of rows inserted, updated and unchanged.
+        dict
+            rows of rows inserted or updated.
+
+        """
+        if upsert:
+            command = self.upsert
+        else:
+            command = self.insert
+        inserted = updated = 0
+        written = {}
+        for d, x in rows.items():
+            cur.execute(command, (id1, d, var, x))
+            row = cur.fetchone()
+            if row is None:
+                continue
+            written[d] = x
+            if row[0]:
+                inserted += 1
+            else:
+                updated += 1
+        return (inserted, updated, len(rows) - inserted - updated), written
 
 
 class Saih_import():
@@ -34,65 +603,73 @@ class Saih_import():
     READ_CHUNK = 5000
 
     def __init__(self, path, tstep, pattern='*.csv',
-                 file_encoding='utf-8-sig', detect_delim=False, delim=';'):
+                 file_encoding='utf-8-sig', detect_delim=False, delim=';',
+                 db=None, pool_size=4, file_names=None):
         """
-        Insert the data in csv files in the tsd or tsh table.
+        Insert the data in csv files in the tsd, tsh or tsm table.
 
         Parameters
         ----------
         path : str
             directory of csv files.
         tstep : str
-            date-time step: must be: ('day', 'hour')
+            date-time step: must be: ('auto', 'day', 'hour', 'minute'). If
+            'auto' the time step of each file is detected and the file is
+            loaded in the table of its time step
         pattern : str, optional
-            The default is '*.csv'.
+            The .zip, .tar.gz and .gz files that match pattern are read
+            as archives of csv files. The default is '*.csv'.
         file_encoding : str
             encoding of the files pattern in path
         detect_delim: bool
-            If true, the delimiter is obtained directly from each csv file
+            If true, the delimiter, decimal separator and encoding are
+            detected from the first READ_CHUNK bytes of each csv file; if a
+            ledger is used, they are cached for each file and not detected
+            again while the file does not change
         delim : str
             delimiter of csv file columns. If detect_delim is true, the value
             of delim is not considered
+        db : str, optional
+            section of the database in pgdb.ini, the same configuration as
+            db_connection.con_get; the connection is taken from a pool shared
+            by all the imports of the process (see saih_pool). If None the
+            database, user and password are asked
+        pool_size : int, optional
+            maximum number of connections of the pool of db; only used by
+            the first Saih_import of the process with this db.
+            The default is 4.
+        file_names : list, optional
+            sources to import (see saih_archives); if None they are the
+            files pattern in path. The default is None.
 
         Returns
         -------
         None.
 
         """
-        if tstep == 'day':
-            self.table = 'saih.tsd'
-            self.pkey = 'tsd_pkey'
-        elif tstep == 'hour':
-            self.table = 'saih.tsh'
-            self.pkey = 'tsh_pkey'
-        else:
+        if tstep != 'auto' and tstep not in TABLES:
             msg = f'tstep {tstep} is not valid'
             logging.append(msg)
             raise ValueError(msg)
 
         self.tstep = tstep
-        self.file_names = self.__file_names_get(path, pattern)
+        if file_names is None:
+            file_names = self.__file_names_get(path, pattern)
+        self.file_names = list(file_names)
 
         self.path = path
         self.pattern = join(path, pattern)
         self.file_encoding = file_encoding
+        self.detect_delim = detect_delim
         self.delim = delim
-        self.insert = \
-            f"""
-            insert into {self.table} values(%s, %s, %s, %s)
-            on conflict on constraint {self.pkey}
-            do nothing
-            """
-        self.upsert = \
-            f"""
-            insert into {self.table} values(%s, %s, %s, %s)
-            on conflict on constraint {self.pkey}
-            do update set v = excluded.v
-            """
+        self.db = db
+        self.pool_size = pool_size
+        self.writers = {}
 
 
-    @staticmethod
-    def __connect():
+    def __connect(self):
+        if self.db is not None:
+            return pool_get(self.db, self.pool_size).getconn()
         db = input('DB: ')
         user = input('User: ')
         passw = input('Password: ')
@@ -100,15 +677,32 @@ class Saih_import():
         return con
 
 
-    def __count_rows(self, cur):
-        cur.execute(f'select count(*) from {self.table}')
-        row = cur.fetchone()
-        return row[0]
+    def __disconnect(self, con):
+        """
+        Returns con to the pool or closes it if it is not from a pool; a
+        broken connection is closed by the pool instead of being reused
+        """
+        if self.db is not None:
+            broken = bool(con.closed)
+            if not broken:
+                try:
+                    con.rollback()
+                except psycopg2.Error:
+                    broken = True
+            pool_get(self.db, self.pool_size).putconn(con, close=broken)
+        else:
+            con.close()
 
 
     @staticmethod
     def __file_names_get(path, pattern):
-        file_names = [name for name in glob.glob(join(path, pattern))]
+        file_names = []
+        for fi in glob.glob(join(path, pattern)):
+            # a bad archive is not imported, the other files are
+            try:
+                file_names += sources_get([fi])
+            except ARCHIVE_ERRORS as e:
+                logging.append(f'{fi} not imported\n{e}')
         if not file_names:
             msg = f'No files in {join(path, pattern)}'
             logging.append(msg)
@@ -116,71 +710,260 @@ class Saih_import():
         return file_names
 
 
-    def __check_time_step(self, strdate, fi, line):
+    def __ask_continue(self, upsert, bulk, workers, ledger, changes_only,
+                       batch_rows, daily):
+        logging.append(f'Files to import: {join(self.path, self.pattern)}')
+        if self.detect_delim:
+            logging.append('Encoding and delimiter detected in each file')
+        else:
+            logging.append(f'Encoding of the files: {self.file_encoding}')
+            logging.append(f'Delimiter of the files: {self.delim}')
+        if self.tstep == 'auto':
+            tables = ', '.join(item[0] for item in TABLES.values())
+        else:
+            tables = TABLES[self.tstep][0]
+        logging.append(f'Insert in table: {tables}')
+        logging.append(f'Upsert: {upsert}')
+        logging.append(f'Bulk: {bulk}')
+        logging.append(f'Workers: {workers}')
+        logging.append(f'Ledger: {ledger}')
+        logging.append(f'Changes only: {changes_only}')
+        logging.append(f'Rows by commit: {batch_rows}')
+        logging.append(f'Daily aggregates of hourly files: {daily}')
+        ans = input('Continue?: ')
+        if ans.lower() not in ('y', 's', '1'):
+            logging.append('Operation aborted')
+            return False
+        else:
+            return True
+
+
+    def __dialects_get(self, file_names, led):
         """
-        Cheks if strdate is a valid datetime type acording self.tstep
+        Dialect of each file: if self.detect_delim is False it is the same
+        for all the files, else it is detected or read from the ledger
+        cache
+
+        Returns
+        -------
+        dict
+            {file name: (encoding, delim, decimal)}
+
+        """
+        if not self.detect_delim:
+            dialect = (self.file_encoding, self.delim,
+                       decimal_get(self.delim))
+            return {fi: dialect for fi in file_names}
+        dialects = {}
+        for fi in file_names:
+            path = abspath(fi)
+            size, mtime = source_stat(fi)
+            cached = None
+            if led is not None:
+                cached = led.dialect_get(path, size, mtime)
+            if cached is None:
+                cached = dialect_detect(fi, self.READ_CHUNK)
+                if led is not None:
+                    led.dialect_record(path, size, mtime, *cached)
+            delim, decimal, encoding = cached
+            dialects[fi] = (encoding, delim, decimal)
+        return dialects
+
+
+    def __writer_get(self, cur, tstep, bulk, changes_only):
+        """
+        Saih_table of tstep; it is created the first time a file with
+        this time step is written. Raises ValueError if the table does not
+        exist, so only the file is not imported
+        """
+        if tstep not in self.writers:
+            writer = Saih_table(tstep)
+            if not writer.exists(cur):
+                raise ValueError(f'table {writer.table} does not exist '
+                                 '(see saih_tables.sql)')
+            if bulk:
+                writer.create_tmp_table(cur)
+            self.writers[tstep] = writer
+        writer = self.writers[tstep]
+        if changes_only and writer.columns is None:
+            writer.columns_get(cur)
+        return writer
+
+
+    @staticmethod
+    def __files_to_read(file_names, led):
+        """
+        Files in file_names that are not in the ledger or have
+        changed since they were imported
 
         Parameters
         ----------
-        strdate : str
-            Date or datetime type as str.
-        fi : str
-            File if strdate.
-        line : int
-            line in fi.
+        file_names : list
+            files.
+        led : Saih_ledger or None
+            If None all the files are returned.
 
-        Raises
+        Returns
+        -------
+        file_names : list
+            files to read.
+        fingerprints : dict
+            {file name: (size, mtime, hash)} of the files to read.
+
+        """
+        if led is None:
+            return file_names, {}
+        to_read = []
+        fingerprints = {}
+        for fi in file_names:
+            path = abspath(fi)
+            size, mtime = source_stat(fi)
+            if led.is_unchanged(path, size, mtime):
+                logging.append(f'{fi} has not changed, skipped', False)
+                continue
+            fp = file_fingerprint(fi)
+            if led.is_unchanged(path, *fp):
+                # same content, only the modification time has changed
+                row = led.file_get(path)
+                led.record(path, *fp, *row[3:])
+                logging.append(f'{fi} has not changed, skipped', False)
+                continue
+            to_read.append(fi)
+            fingerprints[fi] = fp
+        return to_read, fingerprints
+
+
+    @staticmethod
+    def __tail_get(led, fi, id1, var, rows):
+        """
+        If fi was already imported, returns only the rows after the last
+        date imported
+
+        Returns
+        -------
+        dict
+            {date or datetime: value}
+
+        """
+        row = led.file_get(abspath(fi))
+        if row is None or row[3:5] != (id1, var) or row[6] is None:
+            return rows
+        return {d: x for d, x in rows.items() if str(d) > row[6]}
+
+
+    def __files_read(self, file_names, dialects, workers):
+        """
+        Reads file_names; if workers > 1 the files are read in a pool
+        of processes while the caller writes the previous ones. At most
+        2 * workers files are read ahead, so the rows of the files waiting
+        to be written are not all kept in memory
+
+        Parameters
+        ----------
+        file_names : list
+            files to read.
+        dialects : dict
+            {file name: (encoding, delim, decimal)}
+        workers : int
+            number of processes that read the files.
+
+        Yields
         ------
-        ValueError
-            Not a valid strdate or self.tstep.
+        str
+            file name.
+        tuple or Exception
+            read_csv_file result or the exception raised reading the file.
+
+        """
+        if workers <= 1:
+            for fi in file_names:
+                try:
+                    yield fi, read_csv_file(fi, self.tstep, *dialects[fi])
+                except Exception as e:
+                    yield fi, e
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            names = iter(file_names)
+            while True:
+                for fi in islice(names, 2 * workers - len(pending)):
+                    pending.append((fi, executor.submit(read_csv_file, fi,
+                                                        self.tstep,
+                                                        *dialects[fi])))
+                if not pending:
+                    break
+                fi, future = pending.popleft()
+                try:
+                    yield fi, future.result()
+                except Exception as e:
+                    yield fi, e
+
+
+    @staticmethod
+    def __checkpoint_read(checkpoint):
+        """
+        Reads the checkpoint file of an interrupted run
 
         Returns
         -------
-        date or datetime
-            strdate in proper type.
+        dict
+            done: files completely committed; file, nrow: file partially
+            committed and number of its rows committed.
 
         """
-        dt = datetime.strptime(strdate, '%Y-%m-%d %H:%M:%S')
-        if self.tstep == 'day':
-            if dt.hour > 0 or dt.minute > 0 or dt.second > 0:
-                msg = f'Time step must be days in {fi}, line {line}'
-                logging.append(msg)
-                raise ValueError(msg)
-            return date(dt.year, dt.month, dt.day)
-        elif self.tstep == 'hour':
-            if dt.minute > 0 or dt.second > 0:
-                msg = f'Time step must be hours in {fi}, line {line}'
-                logging.append(msg)
-                raise ValueError(msg)
-            return datetime(dt.year, dt.month, dt.day, dt.hour)
-        else:
-            msg = f'tstep {self.tstep} is not valid'
-            logging.append(msg)
-            raise ValueError(msg)
+        ckp = {'done': [], 'file': None, 'nrow': 0}
+        if checkpoint is not None and exists(checkpoint):
+            with open(checkpoint, encoding='utf-8') as f:
+                ckp.update(json.load(f))
+            logging.append(f'Resuming from checkpoint {checkpoint}: '
+                           f'{len(ckp["done"]):d} files done, '
+                           f'{ckp["file"]} row {ckp["nrow"]:d}')
+        return ckp
 
 
-    def __ask_continue(self, upsert):
-        logging.append(f'Files to import: {join(self.path, self.pattern)}')
-        logging.append(f'Encoding of the files: {self.file_encoding}')
-        logging.append(f'Delimiter of the files: {self.delim}')
-        logging.append(f'Insert in table: {self.table}')
-        logging.append(f'Upsert: {upsert}')
-        ans = input('Continue?: ')
-        if ans.lower() not in ('y', 's', '1'):
-            logging.append('Operation aborted')
-            return False
-        else:
-            return True
+    @staticmethod
+    def __checkpoint_write(checkpoint, ckp):
+        if checkpoint is None:
+            return
+        tmp = checkpoint + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(ckp, f)
+        replace(tmp, checkpoint)
 
 
-    def __find_delimiter(self, filename: str):
-        sniffer = csv.Sniffer()
-        with open(filename) as fp:
-            delimiter = sniffer.sniff(fp.read(self.READ_CHUNK)).delimiter
-        return delimiter
+    @staticmethod
+    def __rows_write(writer, cur, id1, var, rows, upsert, bulk,
+                     changes_only):
+        """
+        Writes rows of a file with writer
 
+        Returns
+        -------
+        tuple
+            number of rows inserted, updated and unchanged.
+        dict
+            rows inserted or updated in the database.
 
-    def upsert_data_from_csv_files(self, upsert=True):
+        """
+        unchanged = 0
+        if changes_only and rows:
+            existing = writer.existing_get(cur, id1, var, rows)
+            rows, unchanged = changed_rows_get(rows, existing, upsert)
+
+        if bulk:
+            counts, written = writer.bulk_write(cur, id1, var, rows, upsert)
+        else:
+            counts, written = writer.write(cur, id1, var, rows, upsert)
+        return (counts[0], counts[1], counts[2] + unchanged), written
+
+
+    def upsert_data_from_csv_files(self, upsert=True, bulk=False,
+                                   workers=1, ledger=None,
+                                   changes_only=False, batch_rows=None,
+                                   checkpoint=None, daily=False,
+                                   file_names=None, ask=True, parquet=None,
+                                   quality=None, spike_thresholds=None):
         """
         Inserts or upserts data in csv files
 
@@ -189,6 +972,62 @@ class Saih_import():
         upsert : bool, optional
             If False inserts only new data; is True update values too.
             The default is True.
+        bulk : bool, optional
+            If True the rows of each file are loaded with copy into a
+            temporary table and merged into the table in one statement;
+            if False the rows are inserted one by one.
+            The default is False.
+        workers : int, optional
+            Number of processes that read and check the files; the rows
+            are written by the calling process. A file with errors is not
+            imported, but the rest of the files are.
+            The default is 1.
+        ledger : str, optional
+            sqlite database with the files already imported (see
+            saih_ledger). If it is not None, the files that have not changed
+            are skipped, and of a file that has changed only the dates after
+            the last date imported are loaded. The default is None.
+        changes_only : bool, optional
+            If True, the values in the database for the station and variable
+            of each file are read in a single query in the range of dates of
+            the file, and only the new rows (and the changed rows if upsert)
+            are written. The default is False.
+        batch_rows : int, optional
+            If None all the files are committed at the end; if 0 each file
+            is committed when it has been written; if > 0 a commit is done
+            each time batch_rows rows have been written.
+            The default is None.
+        checkpoint : str, optional
+            json file where the position of each commit is saved. If the
+            file exists when the method is called, the files and rows
+            already committed are skipped; it is removed when the run ends.
+            The default is None.
+        daily : bool, optional
+            If True, for the hourly files the daily aggregates
+            (DAILY_AGGREGATES) of the days with new or changed hourly values
+            are written in the daily table in the same transaction, inserted
+            or upserted as the hourly values (upsert). Only days with the 24
+            hourly values in the file are aggregated.
+            The default is False.
+        file_names : list, optional
+            Files to import; if None the files of path that match pattern.
+            The default is None.
+        ask : bool, optional
+            If True the parameters are shown and a confirmation is asked
+            before importing. The default is True.
+        parquet : str, optional
+            directory of a parquet store (see saih_parquet); if it is not
+            None, the rows of each batch whose value in the database is the
+            one of the file are also written in the store once they are
+            committed. It requires pyarrow. The default is None.
+        quality : str, optional
+            json file; if it is not None, the data quality statistics of
+            each series (see saih_quality) are computed while the rows are
+            loaded and written in quality at the end. The default is None.
+        spike_thresholds : dict, optional
+            {first letter of the variable code: maximum jump between two
+            consecutive values} of the quality statistics. If None
+            saih_quality.SPIKE_THRESHOLDS. The default is None.
 
         Raises
         ------
@@ -197,69 +1036,185 @@ class Saih_import():
 
         Returns
         -------
-        None.
+        dict
+            files: number of files imported; failed: files not imported;
+            inserted, updated, unchanged: number of rows; error: traceback
+            if the import has been interrupted, else None. None if the
+            operation is aborted.
 
         """
-        if not self.__ask_continue(upsert):
+        if ask and not self.__ask_continue(upsert, bulk, workers, ledger,
+                                           changes_only, batch_rows, daily):
             return
 
+        summary = {'files': 0, 'failed': [], 'inserted': 0, 'updated': 0,
+                   'unchanged': 0, 'error': None}
+        led = None
         try:
-            con = Saih_import.__connect()
+            if ledger is not None:
+                led = Saih_ledger(ledger)
+            store = None
+            if parquet is not None:
+                from saih_parquet import Saih_parquet
+                store = Saih_parquet(parquet)
+            qa = None
+            if quality is not None:
+                from saih_quality import Saih_quality
+                qa = Saih_quality(spike_thresholds=spike_thresholds)
+            if file_names is None:
+                file_names = self.file_names
+            file_names, fingerprints = self.__files_to_read(file_names, led)
+            ckp = Saih_import.__checkpoint_read(checkpoint)
+            file_names = [fi for fi in file_names
+                          if abspath(fi) not in ckp['done']]
+
+            con = self.__connect()
             cur = con.cursor()
+            self.writers = {}
 
-            n = 0
-            nr0 = self.__count_rows(cur)
-            for fi in self.file_names:
-                with open(fi, encoding=self.file_encoding) as csv_file:
-                    line = -1
-                    csv_reader = csv.reader(csv_file, delimiter=self.delim)
-                    for line, row in enumerate(csv_reader):
-                        if line == 0:
-                            id1 = row[1][0:5].lower()
-                            var = row[1][5:8].lower()
-                            fi_name = Path(fi).name
-                            print(fi_name, id1, var)
-                            continue
-
-                        d = self.__check_time_step(row[0], fi, line)
-
-                        try:
-                            x = row[1].replace(',', '.')
-                            x = float(x)
-                            if upsert:
-                                cur.execute(self.upsert, (id1, d, var, x))
-                            else:
-                                cur.execute(self.insert, (id1, d, var, x))
-                            n += 1
-                        except ValueError:
-                            msg = f'{fi}, line {line:d} "{row[1]}" is not a number'
-                            logging.append(msg, False)
-                        except Exception:
-                            msg = traceback.format_exc()
-                            logging.append(f'Exception\n{msg}')
-
-            con.commit()
-            nr1 = self.__count_rows(cur)
-            m = nr1-nr0
-            logging.append(f'Rows inserted: {m:d}')
-            if upsert:
-                logging.append(f'Rows updated: {n-m:d}')
-            else:
-                logging.append('Rows updated: 0')
+            total = [0, 0, 0]
+            # ledger rows of the files written but not committed yet
+            imported = []
+
+            def commit():
+                con.commit()
+                if store is not None:
+                    store.flush()
+                Saih_import.__checkpoint_write(checkpoint, ckp)
+                for item in imported:
+                    led.record(*item)
+                imported.clear()
+
+            nrows_to_commit = 0
+            dialects = self.__dialects_get(file_names, led)
+            for fi, result in self.__files_read(file_names, dialects,
+                                                workers):
+                if isinstance(result, Exception):
+                    logging.append(f'{fi} not imported\n{result}')
+                    summary['failed'].append(fi)
+                    continue
+                tstep, id1, var, rows, msgs = result
+                for msg in msgs:
+                    logging.append(msg, False)
+                try:
+                    writer = self.__writer_get(cur, tstep, bulk,
+                                               changes_only)
+                    if daily and tstep == 'hour':
+                        daily_writer = self.__writer_get(cur, 'day', bulk,
+                                                         False)
+                except ValueError as e:
+                    logging.append(f'{fi} not imported\n{e}')
+                    summary['failed'].append(fi)
+                    continue
+
+                path = abspath(fi)
+                if led is not None:
+                    if rows:
+                        date_range = (str(min(rows)), str(max(rows)))
+                    else:
+                        date_range = (None, None)
+                    ledger_item = (path, *fingerprints[fi], id1, var,
+                                   *date_range)
+                    all_rows = rows
+                    rows = Saih_import.__tail_get(led, fi, id1, var, rows)
+                else:
+                    all_rows = rows
+
+                aggregates = None
+                if daily and tstep == 'hour':
+                    how = DAILY_AGGREGATES.get(var[0], 'mean')
+                    aggregates, incomplete = \
+                        daily_aggregates_get(all_rows, how)
+                    daily_counts = [0, 0, 0]
+                    days_written = set()
+                    days_skipped = set()
+
+                items = list(rows.items())
+                nrow0 = ckp['nrow'] if ckp['file'] == path else 0
+                if batch_rows:
+                    step = batch_rows
+                else:
+                    step = max(len(items), 1)
+                counts = [0, 0, 0]
+                for i0 in range(nrow0, max(len(items), 1), step):
+                    chunk = dict(items[i0:i0 + step])
+                    counts1, written = \
+                        Saih_import.__rows_write(writer, cur, id1, var,
+                                                 chunk, upsert, bulk,
+                                                 changes_only)
+                    counts = [a + b for a, b in zip(counts, counts1)]
+                    # with upsert all the rows of chunk have in the database
+                    # the value of the file; without upsert only the
+                    # inserted ones
+                    if store is not None:
+                        store.append(tstep, id1, var,
+                                     chunk if upsert else written)
+                    if qa is not None:
+                        qa.update(tstep, id1, var, chunk)
+                    if aggregates is not None:
+                        days = {d.date() for d in written} - days_written
+                        days_written |= days
+                        days_skipped |= days & incomplete
+                        chunk_daily = {d: aggregates[d] for d in sorted(days)
+                                       if d in aggregates}
+                        counts1, written_daily = \
+                            Saih_import.__rows_write(daily_writer, cur, id1,
+                                                     var, chunk_daily, upsert,
+                                                     bulk, False)
+                        daily_counts = [a + b for a, b in
+                                        zip(daily_counts, counts1)]
+                        if store is not None:
+                            store.append('day', id1, var,
+                                         chunk_daily if upsert
+                                         else written_daily)
+                    nrows_to_commit += len(chunk)
+                    ckp['file'] = path
+                    ckp['nrow'] = i0 + len(chunk)
+                    if ckp['nrow'] >= len(items):
+                        ckp['done'].append(path)
+                        ckp['file'] = None
+                        ckp['nrow'] = 0
+                        if led is not None:
+                            imported.append(ledger_item)
+                    if batch_rows and nrows_to_commit >= batch_rows:
+                        commit()
+                        nrows_to_commit = 0
+
+                total = [a + b for a, b in zip(total, counts)]
+                summary['files'] += 1
+                logging.append(f'{Path(fi).name} {id1} {var} '
+                               f'-> {writer.table}, inserted '
+                               f'{counts[0]:d}, updated {counts[1]:d}, '
+                               f'unchanged {counts[2]:d}')
+                if aggregates is not None:
+                    logging.append(f'{Path(fi).name} {id1} {var} daily '
+                                   f'{how} -> {daily_writer.table}, '
+                                   f'inserted {daily_counts[0]:d}, '
+                                   f'updated {daily_counts[1]:d}, '
+                                   f'incomplete days {len(days_skipped):d}')
+                if batch_rows == 0:
+                    commit()
+
+            commit()
+            if checkpoint is not None and exists(checkpoint):
+                remove(checkpoint)
+            if qa is not None:
+                qa.write(quality)
+                logging.append(f'Data quality report: {quality}')
+            logging.append(f'Rows inserted: {total[0]:d}')
+            logging.append(f'Rows updated: {total[1]:d}')
+            logging.append(f'Rows unchanged: {total[2]:d}')
 
-        except ValueError:
-            msg = traceback.format_exc()
-            if 'line' in locals():
-                msg = f'{fi}, line {line:d}\n{msg}'
-            else:
-                msg = f'{msg}'
-            logging.append(f'{msg}')
         except Exception:
             msg = traceback.format_exc()
             logging.append(f'{msg}')
+            summary['error'] = msg
         finally:
             if 'con' in locals():
-                con.close()
-
-
-
+                self.__disconnect(con)
+            if led is not None:
+                led.close()
+        if 'total' in locals():
+            summary['inserted'], summary['updated'], \
+                summary['unchanged'] = total
+        return summary
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:31 2026
+
+@author: solis
+
+Ledger of the csv files imported by Saih_import. It is a local sqlite
+database with a row for each imported file: path, size, modification time,
+content hash, station (id1), variable and the range of dates in the file.
+Saih_import uses it to skip the files that have not changed since they were
+imported, and to import only the new dates when a file has been downloaded
+again with a later range of dates. It also caches the dialect detected for
+each file (delimiter, decimal separator and encoding), so it is not
+detected again while the file size and modification time do not change.
+"""
+import hashlib
+import sqlite3
+
+from saih_archives import open_source, source_stat
+
+
+def file_fingerprint(fi):
+    """
+    Size, modification time and sha1 of the content of fi
+
+    Parameters
+    ----------
+    fi : str
+        file name or archive member (see saih_archives).
+
+    Returns
+    -------
+    tuple
+        (size, mtime, hash)
+
+    """
+    size, mtime = source_stat(fi)
+    h = hashlib.sha1()
+    with open_source(fi) as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return size, mtime, h.hexdigest()
+
+
+class Saih_ledger():
+
+    def __init__(self, dbname):
+        """
+        Opens the ledger; if it does not exist, it is created
+
+        Parameters
+        ----------
+        dbname : str
+            sqlite database of the ledger.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.dbname = dbname
+        self.con = sqlite3.connect(dbname)
+        self.con.execute(
+            """
+            create table if not exists ledger(
+                path text primary key,
+                size integer,
+                mtime real,
+                hash text,
+                id1 text,
+                var text,
+                date_min text,
+                date_max text
+            )
+            """)
+        self.con.execute(
+            """
+            create table if not exists dialects(
+                path text primary key,
+                size integer,
+                mtime real,
+                delim text,
+                decimal text,
+                encoding text
+            )
+            """)
+        self.con.commit()
+
+
+    def close(self):
+        self.con.close()
+
+
+    def file_get(self, path):
+        """
+        Row of path in the ledger
+
+        Parameters
+        ----------
+        path : str
+            file name.
+
+        Returns
+        -------
+        tuple or None
+            (size, mtime, hash, id1, var, date_min, date_max); None if path
+            has not been imported.
+
+        """
+        cur = self.con.execute(
+            """
+            select size, mtime, hash, id1, var, date_min, date_max
+            from ledger
+            where path = ?
+            """, (path,))
+        return cur.fetchone()
+
+
+    def is_unchanged(self, path, size, mtime, hash_=None):
+        """
+        Checks if path has been imported and has not changed since then.
+        If hash_ is None only size and mtime are compared
+
+        Returns
+        -------
+        bool
+
+        """
+        row = self.file_get(path)
+        if row is None:
+            return False
+        if hash_ is None:
+            return row[0] == size and row[1] == mtime
+        return row[2] == hash_
+
+
+    def record(self, path, size, mtime, hash_, id1, var, date_min,
+               date_max):
+        """
+        Inserts or updates the row of path; date_min and date_max are str
+        or None if the file has no values
+        """
+        self.con.execute(
+            """
+            insert into ledger(path, size, mtime, hash, id1, var, date_min,
+                date_max)
+            values (?, ?, ?, ?, ?, ?, ?, ?)
+            on conflict(path) do update set size = excluded.size,
+                mtime = excluded.mtime, hash = excluded.hash,
+                id1 = excluded.id1, var = excluded.var,
+                date_min = excluded.date_min, date_max = excluded.date_max
+            """, (path, size, mtime, hash_, id1, var, date_min, date_max))
+        self.con.commit()
+
+
+    def dialect_get(self, path, size, mtime):
+        """
+        Dialect of path cached for its size and mtime
+
+        Returns
+        -------
+        tuple or None
+            (delim, decimal, encoding); None if it is not cached or the file
+            has changed.
+
+        """
+        cur = self.con.execute(
+            """
+            select delim, decimal, encoding
+            from dialects
+            where path = ? and size = ? and mtime = ?
+            """, (path, size, mtime))
+        return cur.fetchone()
+
+
+    def dialect_record(self, path, size, mtime, delim, decimal, encoding):
+        self.con.execute(
+            """
+            insert into dialects(path, size, mtime, delim, decimal, encoding)
+            values (?, ?, ?, ?, ?, ?)
+            on conflict(path) do update set size = excluded.size,
+                mtime = excluded.mtime, delim = excluded.delim,
+                decimal = excluded.decimal, encoding = excluded.encoding
+            """, (path, size, mtime, delim, decimal, encoding))
+        self.con.commit()
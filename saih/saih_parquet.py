@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:30:12 2026
+
+@author: solis
+
+Local copy in parquet files of the series loaded by Saih_import, to read
+long series without querying the database. The store is partitioned by
+station and year:
+
+    root/id1=<station>/year=<yyyy>/<var>-<tstep>-<stamp>-<seq>-<uid>.parquet
+
+Each file has the columns tstep, var, date and v. Every batch committed by
+Saih_import adds new files; when a date is in several files the value of
+the last written file is the valid one, as in the database. The write order
+is (stamp, seq): stamp is a nanosecond time that never repeats in a process
+and seq the number of the file in its flush; uid is random, so two files
+never have the same name even if the clock resolution is coarse. compact
+rewrites each partition in a single file.
+
+It requires pyarrow; pandas only for series_get.
+"""
+import glob
+from os import makedirs, remove
+from os.path import basename, join
+import threading
+from time import time_ns
+from uuid import uuid4
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+SCHEMA = pa.schema([('tstep', pa.string()), ('var', pa.string()),
+                    ('date', pa.timestamp('s')), ('v', pa.float64())])
+
+_stamp_lock = threading.Lock()
+_last_stamp = 0
+
+
+def _stamp_get():
+    """
+    time_ns, always greater than the previous one returned in the process
+    """
+    global _last_stamp
+    with _stamp_lock:
+        _last_stamp = max(time_ns(), _last_stamp + 1)
+        return _last_stamp
+
+
+def _file_name(var, tstep, stamp, seq):
+    return f'{var}-{tstep}-{stamp}-{seq}-{uuid4().hex[:8]}.parquet'
+
+
+def _write_order(fi):
+    parts = basename(fi).split('.')[0].split('-')
+    return int(parts[2]), int(parts[3])
+
+
+class Saih_parquet():
+
+    def __init__(self, root):
+        """
+        Writer of the store
+
+        Parameters
+        ----------
+        root : str
+            directory of the store; it is created if it does not exist.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.root = root
+        makedirs(root, exist_ok=True)
+        self.pending = []
+
+
+    def append(self, tstep, id1, var, rows):
+        """
+        Adds rows to the batch that will be written by flush
+
+        Parameters
+        ----------
+        tstep : str
+            time step of rows.
+        id1 : str
+            station code.
+        var : str
+            variable code.
+        rows : dict
+            {date or datetime: value}
+
+        Returns
+        -------
+        None.
+
+        """
+        if rows:
+            self.pending.append((tstep, id1, var, rows))
+
+
+    def flush(self):
+        """
+        Writes the pending rows, a file by station, variable, time step
+        and year
+        """
+        stamp = _stamp_get()
+        seq = 0
+        for tstep, id1, var, rows in self.pending:
+            dates = np.array(list(rows.keys()), dtype='datetime64[s]')
+            values = np.array(list(rows.values()), dtype=np.float64)
+            years = dates.astype('datetime64[Y]').astype(int) + 1970
+            for year in np.unique(years):
+                sel = years == year
+                n = int(sel.sum())
+                table = pa.table([pa.array([tstep] * n, pa.string()),
+                                  pa.array([var] * n, pa.string()),
+                                  pa.array(dates[sel]),
+                                  pa.array(values[sel])], schema=SCHEMA)
+                dst = join(self.root, f'id1={id1}', f'year={year}')
+                makedirs(dst, exist_ok=True)
+                pq.write_table(table, join(dst, _file_name(var, tstep, stamp,
+                                                           seq)))
+                seq += 1
+        self.pending.clear()
+
+
+def _files_get(root, id1, var, tstep, start, end):
+    """
+    Files of the store with data of id1, var and tstep between the years of
+    start and end, in the order they were written
+    """
+    files = []
+    for dir_year in glob.glob(join(root, f'id1={id1}', 'year=*')):
+        year = int(basename(dir_year)[5:])
+        if start is not None and year < np.datetime64(start, 'Y') \
+                .astype(int) + 1970:
+            continue
+        if end is not None and year > np.datetime64(end, 'Y') \
+                .astype(int) + 1970:
+            continue
+        pattern = f'{var}-{tstep}-*.parquet'
+        files += glob.glob(join(dir_year, pattern))
+    return sorted(files, key=_write_order)
+
+
+def arrays_get(root, id1, var, tstep, start=None, end=None):
+    """
+    Series of a station, variable and time step read from the store; the
+    files are memory-mapped. The time steps are never merged: a daily
+    aggregate and the hourly value of 00:00 have the same date
+
+    Parameters
+    ----------
+    root : str
+        directory of the store.
+    id1 : str
+        station code.
+    var : str
+        variable code.
+    tstep : str
+        time step: 'day', 'hour' or 'minute'.
+    start : str or date, optional
+        first date. The default is None.
+    end : str or date, optional
+        last date. The default is None.
+
+    Returns
+    -------
+    dates : ndarray
+        datetime64[s], sorted.
+    values : ndarray
+        float64.
+
+    """
+    files = _files_get(root, id1, var, tstep, start, end)
+    if not files:
+        return np.empty(0, dtype='datetime64[s]'), np.empty(0)
+    tables = [pq.read_table(fi, columns=['date', 'v'], memory_map=True)
+              for fi in files]
+    table = pa.concat_tables(tables)
+    dates = table.column('date').to_numpy().astype('datetime64[s]')
+    values = table.column('v').to_numpy()
+
+    sel = np.ones(dates.size, dtype=bool)
+    if start is not None:
+        sel &= dates >= np.datetime64(start, 's')
+    if end is not None:
+        sel &= dates <= np.datetime64(end, 's')
+    dates = dates[sel]
+    values = values[sel]
+    # the last written value of each date is the valid one
+    rdates = dates[::-1]
+    udates, idx = np.unique(rdates, return_index=True)
+    return udates, values[::-1][idx]
+
+
+def series_get(root, id1, var, tstep, start=None, end=None):
+    """
+    The same as arrays_get but as a pandas Series indexed by date
+    """
+    import pandas as pd
+    dates, values = arrays_get(root, id1, var, tstep, start, end)
+    return pd.Series(values, index=pd.DatetimeIndex(dates, name='date'),
+                     name=f'{id1}{var}')
+
+
+def compact(root):
+    """
+    Rewrites each partition of the store in a file by variable and time
+    step, keeping the last written value of each date
+    """
+    for dir_year in glob.glob(join(root, 'id1=*', 'year=*')):
+        files = glob.glob(join(dir_year, '*.parquet'))
+        keys = {tuple(basename(fi).split('-')[0:2]) for fi in files}
+        for var, tstep in keys:
+            group = [fi for fi in files
+                     if tuple(basename(fi).split('-')[0:2]) == (var, tstep)]
+            if len(group) < 2:
+                continue
+            group.sort(key=_write_order)
+            table = pa.concat_tables([pq.read_table(fi) for fi in group])
+            dates = table.column('date').to_numpy()[::-1]
+            _, idx = np.unique(dates, return_index=True)
+            idx = table.num_rows - 1 - idx
+            table = table.take(pa.array(np.sort(idx)))
+            pq.write_table(table, join(dir_year, _file_name(var, tstep,
+                                                            _stamp_get(), 0)))
+            for fi in group:
+                remove(fi)
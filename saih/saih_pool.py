@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:21:47 2026
+
+@author: solis
+
+Pools of connections to the postgres databases of pgdb.ini. A pool is
+created the first time it is asked for and then it is shared by all the
+Saih_import objects and threads of the process, so repeated or parallel
+imports reuse the open connections instead of opening a new one each time.
+pgdb.ini has a section for each database with the arguments of
+psycopg2.connect (host, database, user, password...).
+"""
+from configparser import ConfigParser
+from os.path import abspath, dirname, join
+import threading
+
+from psycopg2.pool import ThreadedConnectionPool
+
+PGDB_INI = join(dirname(dirname(abspath(__file__))), 'pgdb.ini')
+
+_pools = {}
+_lock = threading.Lock()
+
+
+def pool_get(db, size=4, ini=PGDB_INI):
+    """
+    Pool of connections to db
+
+    Parameters
+    ----------
+    db : str
+        section of the database in ini.
+    size : int, optional
+        maximum number of connections of the pool; only used when the pool
+        is created. The default is 4.
+    ini : str, optional
+        configuration file. The default is PGDB_INI.
+
+    Raises
+    ------
+    ValueError
+        db is not a section of ini.
+
+    Returns
+    -------
+    ThreadedConnectionPool
+
+    """
+    with _lock:
+        if db not in _pools:
+            config = ConfigParser()
+            config.read(ini)
+            if not config.has_section(db):
+                raise ValueError(f'{db} is not a section of {ini}')
+            params = dict(config.items(db))
+            _pools[db] = ThreadedConnectionPool(1, size, **params)
+        return _pools[db]
+
+
+def pools_close():
+    """
+    Closes all the connections of all the pools
+    """
+    with _lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 12:15:40 2026
+
+@author: solis
+
+Data quality statistics of the series imported by Saih_import, computed
+while the rows are loaded, so there is no need to query the database again
+after the import. For each time step, station and variable:
+    n, min, max, first and last date
+    gaps: number of gaps, missing time steps and the longest gap
+    flat runs: runs of at least flat_min consecutive equal values and the
+        longest run
+    spikes: jumps between consecutive values larger than the threshold of
+        the variable
+The rows of a series can arrive in several batches; the state at the end of
+a batch (last date, last value and the current run of equal values) is
+kept, so the statistics are the same as if the series were read at once,
+provided that the batches of a series arrive in date order.
+"""
+import json
+
+import numpy as np
+
+from saih_import import TABLES
+
+# maximum jump between two consecutive values by the first letter of the
+# variable code: n level (m), p precipitation (mm); the variables not in the
+# dict are not checked for spikes
+SPIKE_THRESHOLDS = {'n': 1., 'p': 50.}
+
+
+class Saih_quality():
+
+    # maximum number of dates stored for the spikes of each series
+    MAX_DATES = 20
+
+    def __init__(self, flat_min=6, spike_thresholds=None):
+        """
+        Parameters
+        ----------
+        flat_min : int, optional
+            minimum length of a run of equal values to be reported.
+            The default is 6.
+        spike_thresholds : dict, optional
+            {first letter of the variable code: maximum jump between two
+            consecutive values}; the variables without threshold are not
+            checked. If None SPIKE_THRESHOLDS. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.flat_min = flat_min
+        if spike_thresholds is None:
+            spike_thresholds = SPIKE_THRESHOLDS
+        self.spike_thresholds = spike_thresholds
+        self.stats = {}
+
+
+    @staticmethod
+    def __stats_new():
+        return {'n': 0, 'min': None, 'max': None, 'first': None,
+                'last': None, 'gaps': 0, 'missing_steps': 0,
+                'longest_gap': None, 'flat_runs': 0, 'longest_flat': None,
+                'spikes': 0, 'spike_dates': [],
+                # state of the last batch
+                '_last_value': None, '_run_start': None, '_run_len': 0}
+
+
+    def __run_close(self, st, start, length):
+        if length >= self.flat_min:
+            st['flat_runs'] += 1
+            if st['longest_flat'] is None or \
+                length > st['longest_flat'][1]:
+                st['longest_flat'] = (start, int(length))
+
+
+    def update(self, tstep, id1, var, rows):
+        """
+        Adds a batch of rows of a series
+
+        Parameters
+        ----------
+        tstep : str
+            time step of the rows.
+        id1 : str
+            station code.
+        var : str
+            variable code.
+        rows : dict
+            {date or datetime: value}
+
+        Returns
+        -------
+        None.
+
+        """
+        if not rows:
+            return
+        key = f'{tstep} {id1} {var}'
+        st = self.stats.setdefault(key, Saih_quality.__stats_new())
+
+        dates = np.array(list(rows.keys()), dtype='datetime64[s]')
+        values = np.array(list(rows.values()), dtype=np.float64)
+        order = np.argsort(dates, kind='stable')
+        dates = dates[order]
+        values = values[order]
+
+        st['n'] += dates.size
+        vmin, vmax = float(np.nanmin(values)), float(np.nanmax(values))
+        st['min'] = vmin if st['min'] is None else min(st['min'], vmin)
+        st['max'] = vmax if st['max'] is None else max(st['max'], vmax)
+        if st['first'] is None:
+            st['first'] = str(dates[0])
+
+        # the last row of the previous batch links both batches
+        linked = st['last'] is not None and \
+            dates[0] > np.datetime64(st['last'], 's')
+        if linked:
+            dates = np.concatenate(([np.datetime64(st['last'], 's')], dates))
+            values = np.concatenate(([st['_last_value']], values))
+        elif st['_run_len'] > 0:
+            self.__run_close(st, st['_run_start'], st['_run_len'])
+            st['_run_len'] = 0
+
+        # gaps
+        step = np.timedelta64(1, TABLES[tstep][2])
+        nsteps = np.diff(dates) // step
+        igaps = np.flatnonzero(nsteps > 1)
+        st['gaps'] += igaps.size
+        st['missing_steps'] += int(np.sum(nsteps[igaps] - 1))
+        if igaps.size > 0:
+            i = igaps[np.argmax(nsteps[igaps])]
+            missing = int(nsteps[i] - 1)
+            if st['longest_gap'] is None or missing > st['longest_gap'][2]:
+                st['longest_gap'] = (str(dates[i]), str(dates[i + 1]),
+                                     missing)
+
+        # runs of equal consecutive values without gaps
+        new_run = np.ones(dates.size, dtype=bool)
+        new_run[1:] = (values[1:] != values[:-1]) | (nsteps != 1)
+        starts = np.flatnonzero(new_run)
+        lengths = np.diff(np.append(starts, dates.size))
+        if linked:
+            # the first run continues the open run of the previous batch
+            lengths[0] += st['_run_len'] - 1
+            run_starts = [st['_run_start']] + \
+                [str(d) for d in dates[starts[1:]]]
+        else:
+            run_starts = [str(d) for d in dates[starts]]
+        for start, length in zip(run_starts[:-1], lengths[:-1]):
+            self.__run_close(st, start, length)
+        st['_run_start'] = run_starts[-1]
+        st['_run_len'] = int(lengths[-1])
+
+        # spikes
+        threshold = self.spike_thresholds.get(var[0])
+        if threshold is not None:
+            ispikes = np.flatnonzero(np.abs(np.diff(values)) > threshold)
+            st['spikes'] += ispikes.size
+            free = Saih_quality.MAX_DATES - len(st['spike_dates'])
+            st['spike_dates'] += [str(dates[i + 1])
+                                  for i in ispikes[:max(free, 0)]]
+
+        st['last'] = str(dates[-1])
+        st['_last_value'] = float(values[-1])
+
+
+    def report(self):
+        """
+        Statistics of all the series
+
+        Returns
+        -------
+        dict
+            {'tstep id1 var': statistics}
+
+        """
+        report = {}
+        for key, st in self.stats.items():
+            st = dict(st)
+            if st['_run_len'] > 0:
+                self.__run_close(st, st['_run_start'], st['_run_len'])
+            report[key] = {k: v for k, v in st.items()
+                           if not k.startswith('_')}
+        return report
+
+
+    def write(self, dst):
+        """
+        Writes the report in the json file dst
+        """
+        with open(dst, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=1)
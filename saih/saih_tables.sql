@@ -0,0 +1,7 @@
+-- tables of saih_import that are not created by the chs database scripts
+-- saih.tsd (daily) and saih.tsh (hourly) must exist
+
+-- minute values: same structure and primary key as saih.tsh; the primary key
+-- constraint is tsm_pkey (TABLES in saih_import.py)
+create table if not exists saih.tsm (like saih.tsh including all)
+;
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:05:22 2026
+
+@author: solis
+
+Continuous import of the csv files downloaded from the chs website: a
+directory is polled and the new or changed files are imported with
+Saih_import using the bulk path as soon as they are completely written.
+
+A file is considered completely written when its size and modification time
+have not changed between two polls and it has not been modified in the last
+settle seconds. The ready files are put in a bounded queue; a loader thread
+takes them in batches and imports them, so when the loader falls behind the
+poller waits. The ledger (see saih_ledger) avoids importing the same file
+twice, also after a restart. Every poll writes a heartbeat json file with the
+state of the service and the accumulated counters.
+"""
+from datetime import datetime
+import glob
+import json
+from os import replace
+from os.path import abspath, join
+import queue
+import threading
+from time import time
+import traceback
+
+import littleLogging as logging
+from saih_archives import ARCHIVE_ERRORS, source_stat, sources_get
+from saih_import import Saih_import
+from saih_ledger import Saih_ledger
+from saih_pool import pools_close
+
+
+class Saih_watch():
+
+    def __init__(self, path, db, ledger, heartbeat, tstep='auto',
+                 pattern='*.csv', file_encoding='utf-8-sig',
+                 detect_delim=True, delim=';',
+                 interval=30., settle=10., queue_size=100, batch_files=20,
+                 workers=1, loaders=1, upsert=True, changes_only=True,
+                 daily=False):
+        """
+        Parameters
+        ----------
+        path : str
+            directory to watch.
+        db : str
+            section of the database in pgdb.ini; the service does not ask
+            for credentials.
+        ledger : str
+            sqlite database with the files already imported.
+        heartbeat : str
+            json file with the state of the service, written every poll.
+        tstep : str, optional
+            see Saih_import. The default is 'auto'.
+        pattern : str, optional
+            files to import in path; use '*' to import .zip, .tar.gz and
+            .gz downloads too. The default is '*.csv'.
+        file_encoding : str, optional
+            The default is 'utf-8-sig'.
+        detect_delim : bool, optional
+            see Saih_import. The default is True.
+        delim : str, optional
+            The default is ';'.
+        interval : float, optional
+            seconds between polls. The default is 30.
+        settle : float, optional
+            seconds without changes before a file is imported.
+            The default is 10.
+        queue_size : int, optional
+            maximum number of files waiting to be imported.
+            The default is 100.
+        batch_files : int, optional
+            maximum number of files imported in a call to Saih_import.
+            The default is 20.
+        workers : int, optional
+            processes that read the files of a batch. The default is 1.
+        loaders : int, optional
+            threads that import batches at the same time; each one takes a
+            connection from the pool of db, whose size is loaders.
+            The default is 1.
+        upsert : bool, optional
+            The default is True.
+        changes_only : bool, optional
+            The default is True.
+        daily : bool, optional
+            The default is False.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.path = path
+        self.db = db
+        self.ledger = ledger
+        self.heartbeat = heartbeat
+        self.tstep = tstep
+        self.pattern = pattern
+        self.file_encoding = file_encoding
+        self.detect_delim = detect_delim
+        self.delim = delim
+        self.interval = interval
+        self.settle = settle
+        self.batch_files = batch_files
+        self.workers = workers
+        self.loaders = loaders
+        self.upsert = upsert
+        self.changes_only = changes_only
+        self.daily = daily
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        # sources in the queue or being imported
+        self.pending = set()
+        # (size, mtime) of the sources that could not be imported; they are
+        # not tried again until they change
+        self.failed = {}
+        self.metrics = {'started': datetime.now().isoformat(),
+                        'heartbeat': None, 'polls': 0, 'batches': 0,
+                        'files': 0, 'failed': 0, 'inserted': 0,
+                        'updated': 0, 'unchanged': 0, 'queued': 0,
+                        'last_batch': None, 'last_error': None}
+
+
+    def __heartbeat_write(self):
+        with self.lock:
+            self.metrics['heartbeat'] = datetime.now().isoformat()
+            self.metrics['queued'] = self.queue.qsize()
+            metrics = dict(self.metrics)
+        tmp = self.heartbeat + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(metrics, f, indent=1)
+        replace(tmp, self.heartbeat)
+
+
+    def __ready_files_get(self, previous, led):
+        """
+        Sources that are completely written and not in the ledger
+
+        Parameters
+        ----------
+        previous : dict
+            {file: (size, mtime)} of the previous poll; it is updated.
+        led : Saih_ledger
+
+        Returns
+        -------
+        list
+            sources to import.
+
+        """
+        now = time()
+        current = {}
+        ready = []
+        for fi in glob.glob(join(self.path, self.pattern)):
+            try:
+                current[fi] = source_stat(fi)
+            except OSError:
+                continue
+            if previous.get(fi) != current[fi] or \
+                now - current[fi][1] < self.settle:
+                continue
+            ready.append(fi)
+        previous.clear()
+        previous.update(current)
+
+        sources = []
+        for fi in ready:
+            with self.lock:
+                if self.failed.get(abspath(fi)) == current[fi]:
+                    continue
+            # a bad archive fails alone, until it changes
+            try:
+                members = [(source, source_stat(source))
+                           for source in sources_get([fi])]
+            except ARCHIVE_ERRORS as e:
+                logging.append(f'{fi} not imported\n{e}')
+                with self.lock:
+                    self.failed[abspath(fi)] = current[fi]
+                    self.metrics['failed'] += 1
+                continue
+            for source, size_mtime in members:
+                path = abspath(source)
+                with self.lock:
+                    if path in self.pending or \
+                        self.failed.get(path) == size_mtime:
+                        continue
+                if led.is_unchanged(path, *size_mtime):
+                    continue
+                sources.append(source)
+        return sources
+
+
+    def __poll(self):
+        led = Saih_ledger(self.ledger)
+        previous = {}
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    for source in self.__ready_files_get(previous, led):
+                        with self.lock:
+                            self.pending.add(abspath(source))
+                        # blocks while the queue is full
+                        while not self.stop_event.is_set():
+                            try:
+                                self.queue.put(source, timeout=1.)
+                                break
+                            except queue.Full:
+                                self.__heartbeat_write()
+                    with self.lock:
+                        self.metrics['polls'] += 1
+                except Exception:
+                    msg = traceback.format_exc()
+                    logging.append(f'Poll error\n{msg}')
+                    with self.lock:
+                        self.metrics['last_error'] = msg
+                self.__heartbeat_write()
+                self.stop_event.wait(self.interval)
+        finally:
+            led.close()
+
+
+    def __load(self):
+        while not self.stop_event.is_set():
+            try:
+                batch = [self.queue.get(timeout=1.)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_files:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                saih = Saih_import(self.path, self.tstep, self.pattern,
+                                   self.file_encoding, self.detect_delim,
+                                   self.delim, db=self.db,
+                                   pool_size=self.loaders, file_names=batch)
+                summary = saih.upsert_data_from_csv_files(
+                    self.upsert, bulk=True, workers=self.workers,
+                    ledger=self.ledger, changes_only=self.changes_only,
+                    batch_rows=0, daily=self.daily, ask=False)
+            except Exception:
+                summary = {'files': 0, 'failed': batch, 'inserted': 0,
+                           'updated': 0, 'unchanged': 0,
+                           'error': traceback.format_exc()}
+            with self.lock:
+                for source in batch:
+                    self.pending.discard(abspath(source))
+                for source in summary['failed']:
+                    try:
+                        self.failed[abspath(source)] = source_stat(source)
+                    except OSError:
+                        pass
+                for key in ('files', 'inserted', 'updated', 'unchanged'):
+                    self.metrics[key] += summary[key]
+                self.metrics['failed'] += len(summary['failed'])
+                self.metrics['batches'] += 1
+                self.metrics['last_batch'] = datetime.now().isoformat()
+                if summary['error'] is not None:
+                    self.metrics['last_error'] = summary['error']
+            logging.dump()
+
+
+    def run(self):
+        """
+        Polls the directory until stop is called or the process receives
+        a KeyboardInterrupt (Ctrl+C)
+        """
+        logging.append(f'Watching {join(self.path, self.pattern)} every '
+                       f'{self.interval} s')
+        loaders = [threading.Thread(target=self.__load, daemon=True)
+                   for i in range(self.loaders)]
+        for loader in loaders:
+            loader.start()
+        try:
+            self.__poll()
+        except KeyboardInterrupt:
+            logging.append('Stopped by the user')
+        finally:
+            self.stop()
+            for loader in loaders:
+                loader.join()
+            pools_close()
+            self.__heartbeat_write()
+
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 27 12:20:44 2026
+
+@author: solis
+
+Tests of saih_archives; run with pytest from this directory
+"""
+from io import BytesIO
+import os
+import tarfile
+
+from saih_archives import MEMBER_SEP, open_source, source_stat, sources_get
+
+
+def tar_write(fi, members, mtime):
+    with tarfile.open(fi, 'w:gz') as t:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = mtime
+            t.addfile(info, BytesIO(content))
+
+
+def test_tar_members(tmp_path):
+    fi = str(tmp_path / 'a.tar.gz')
+    members = {f'm{i}.csv': f'Fecha;06A01P0{i} Lluvia\n'.encode()
+               for i in range(3)}
+    members['notes.txt'] = b'x'
+    tar_write(fi, members, 1600000000)
+
+    sources = sources_get([fi])
+    assert sources == [fi + MEMBER_SEP + f'm{i}.csv' for i in range(3)]
+    for source in sources:
+        content = members[source.split(MEMBER_SEP)[1]]
+        assert source_stat(source) == (len(content), 1600000000.)
+        with open_source(source) as f:
+            assert f.read() == content
+        with open_source(source, 'utf-8') as f:
+            assert f.readline().startswith('Fecha;06A01P0')
+
+    # a changed archive is read again
+    members = {'m0.csv': b'Fecha;06A01N01 Nivel\n'}
+    tar_write(fi, members, 1700000000)
+    os.utime(fi, (1700000000, 1700000000))
+    assert sources_get([fi]) == [fi + MEMBER_SEP + 'm0.csv']
+    assert source_stat(fi + MEMBER_SEP + 'm0.csv') == \
+        (len(members['m0.csv']), 1700000000.)
+    with open_source(fi + MEMBER_SEP + 'm0.csv') as f:
+        assert f.read() == members['m0.csv']
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 27 10:40:05 2026
+
+@author: solis
+
+Tests of saih_import; run with pytest from this directory. The database is
+replaced by an in-memory fake that runs the statements of Saih_table
+"""
+from datetime import date, datetime, timedelta
+import re
+
+import numpy as np
+import pytest
+
+import saih_import
+from saih_import import MAX_WRONG_LINES, changed_rows_get, \
+    daily_aggregates_get, dates_parse, read_csv_file, values_parse
+
+
+def test_dates_parse():
+    tstep, dates = dates_parse(['2020-01-01 00:00:00', '2020-01-02 00:00:00'],
+                               [1, 2], 'auto', 'f.csv')
+    assert tstep == 'day'
+    assert dates == [date(2020, 1, 1), date(2020, 1, 2)]
+    tstep, dates = dates_parse(['2020-01-01 00:00:00', '2020-01-01 01:00:00'],
+                               [1, 2], 'auto', 'f.csv')
+    assert tstep == 'hour'
+    assert dates == [datetime(2020, 1, 1, 0), datetime(2020, 1, 1, 1)]
+    with pytest.raises(ValueError, match='lines 2'):
+        dates_parse(['2020-01-01 00:00:00', '2020-01-01 00:01:00'], [1, 2],
+                    'hour', 'f.csv')
+    with pytest.raises(ValueError, match='lines 3'):
+        dates_parse(['2020-01-01 00:00:00', 'x'], [1, 3], 'hour', 'f.csv')
+
+
+def test_values_parse():
+    values, valid = values_parse(['1,5', ' -2 ', '', 'n/a', '1,2,3', '3e1'])
+    assert valid.tolist() == [True, True, False, False, False, True]
+    assert values[valid].tolist() == [1.5, -2., 30.]
+    values, valid = values_parse(['1.5'], '.')
+    assert values.tolist() == [1.5]
+
+
+def test_read_csv_file_outage(tmp_path):
+    fi = str(tmp_path / 'p.csv')
+    with open(fi, 'w', encoding='utf-8') as f:
+        f.write('Fecha;06A01P01 Lluvia\n')
+        for h in range(5000):
+            x = '1,5' if h < 2 else 'n/a'
+            f.write(f'{datetime(2020, 1, 1) + timedelta(hours=h)};{x}\n')
+    tstep, id1, var, rows, msgs = read_csv_file(fi, 'auto', 'utf-8', ';')
+    assert (tstep, id1, var, len(rows)) == ('hour', '06a01', 'p01', 2)
+    assert len(msgs) == 1
+    assert '4998 values are not a number' in msgs[0]
+    lines = ', '.join(str(line) for line in range(3, 3 + MAX_WRONG_LINES))
+    assert msgs[0].endswith(f'in lines {lines}, ...')
+
+
+def test_changed_rows_get():
+    d = [datetime(2020, 1, 1, h) for h in range(3)]
+    rows = {d[0]: 1., d[1]: 2., d[2]: 3.}
+    existing = [(d[0], 1.), (d[1], 5.)]
+    assert changed_rows_get(rows, existing, False) == ({d[2]: 3.}, 2)
+    assert changed_rows_get(rows, existing, True) == \
+        ({d[1]: 2., d[2]: 3.}, 1)
+    assert changed_rows_get(rows, [], False) == (rows, 0)
+
+
+def test_daily_aggregates_get():
+    rows = {datetime(2020, 1, 1, h): float(h) for h in range(24)}
+    rows[datetime(2020, 1, 2, 0)] = 1.
+    aggregates, incomplete = daily_aggregates_get(rows, 'sum')
+    assert aggregates == {date(2020, 1, 1): 276.}
+    assert incomplete == {date(2020, 1, 2)}
+    assert daily_aggregates_get(rows, 'max')[0] == {date(2020, 1, 1): 23.}
+    assert daily_aggregates_get(rows, 'mean')[0] == {date(2020, 1, 1): 11.5}
+    with pytest.raises(ValueError):
+        daily_aggregates_get(rows, 'min')
+
+
+class Fake_cursor():
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.tmp = []
+        self.result = []
+
+    def copy_expert(self, sql, buf):
+        for line in buf.getvalue().splitlines():
+            id1, d, var, v = line.split('\t')
+            self.tmp.append((id1, d, var, float(v)))
+
+    def execute(self, sql, params=None):
+        self.result = []
+        if 'to_regclass' in sql:
+            self.result = [('t',)]
+            return
+        m = re.search(r'insert into (\S+)', sql)
+        if m is None:
+            return
+        table = self.tables.setdefault(m.group(1), {})
+        upsert = 'do update' in sql
+        rows = self.tmp if params is None else [params]
+        for id1, d, var, v in rows:
+            key = (id1, np.datetime64(d, 's'), var)
+            if key not in table:
+                table[key] = v
+                inserted = True
+            elif upsert and table[key] != v:
+                table[key] = v
+                inserted = False
+            else:
+                continue
+            if params is None:
+                self.result.append((id1, key[1].tolist(), var, v, inserted))
+            else:
+                self.result.append((inserted,))
+        self.tmp = []
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return self.result
+
+
+class Fake_connection():
+
+    closed = 0
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def cursor(self):
+        return Fake_cursor(self.tables)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class Fake_pool():
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def getconn(self):
+        return Fake_connection(self.tables)
+
+    def putconn(self, con, close=False):
+        pass
+
+
+@pytest.mark.parametrize('bulk', [True, False])
+def test_parquet_mirror_keeps_database_values(tmp_path, monkeypatch, bulk):
+    pytest.importorskip('pyarrow')
+    from saih_parquet import arrays_get
+
+    with open(tmp_path / 'p.csv', 'w', encoding='utf-8') as f:
+        f.write('Fecha;06A01P01 Lluvia\n')
+        for h in range(24):
+            f.write(f'2020-01-01 {h:02d}:00:00;{h},5\n')
+    first = np.datetime64('2020-01-01T00:00:00')
+    tables = {'saih.tsh': {('06a01', first, 'p01'): -999.},
+              'saih.tsd': {('06a01', np.datetime64('2020-01-01', 's'),
+                            'p01'): -1.}}
+    monkeypatch.setattr(saih_import, 'pool_get',
+                        lambda db, size=4: Fake_pool(tables))
+    root = str(tmp_path / 'store')
+
+    def store_matches_db(tstep, table):
+        dates, values = arrays_get(root, '06a01', 'p01', tstep)
+        for d, x in zip(dates, values):
+            assert tables[table][('06a01', d, 'p01')] == x
+        return dates.size
+
+    saih = saih_import.Saih_import(str(tmp_path), 'auto', db='ipa')
+    summary = saih.upsert_data_from_csv_files(False, bulk, parquet=root,
+                                              daily=True, ask=False)
+    assert summary['inserted'] == 23
+    assert tables['saih.tsh'][('06a01', first, 'p01')] == -999.
+    assert store_matches_db('hour', 'saih.tsh') == 23
+    assert store_matches_db('day', 'saih.tsd') == 0
+
+    saih = saih_import.Saih_import(str(tmp_path), 'auto', db='ipa')
+    summary = saih.upsert_data_from_csv_files(True, bulk, parquet=root,
+                                              daily=True, ask=False)
+    assert summary['updated'] == 1
+    assert tables['saih.tsh'][('06a01', first, 'p01')] == 0.5
+    assert store_matches_db('hour', 'saih.tsh') == 24
+    assert store_matches_db('day', 'saih.tsd') == 1
+
+
+def test_bad_archive_is_skipped(tmp_path):
+    (tmp_path / 'good.csv').write_text('Fecha;06A01P01 Lluvia\n')
+    (tmp_path / 'bad.zip').write_bytes(b'PK\x03\x04garbage')
+    (tmp_path / 'bad.tar.gz').write_bytes(b'xx')
+    saih = saih_import.Saih_import(str(tmp_path), 'auto', '*', db='ipa')
+    assert saih.file_names == [str(tmp_path / 'good.csv')]
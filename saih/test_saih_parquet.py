@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 27 10:12:31 2026
+
+@author: solis
+
+Tests of saih_parquet; run with pytest from this directory
+"""
+from datetime import date, datetime
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from saih_parquet import Saih_parquet, arrays_get, compact, series_get
+
+
+def test_round_trip(tmp_path):
+    root = str(tmp_path / 'store')
+    store = Saih_parquet(root)
+    hourly = {datetime(2020, 12, 31, 22): 1., datetime(2020, 12, 31, 23): 2.,
+              datetime(2021, 1, 1, 0): 3.}
+    store.append('hour', '06a01', 'p01', hourly)
+    store.append('day', '06a01', 'p01', {date(2021, 1, 1): 24.})
+    store.flush()
+    # a later batch changes a value
+    store.append('hour', '06a01', 'p01', {datetime(2020, 12, 31, 23): 5.})
+    store.flush()
+
+    expected = (np.array(['2020-12-31T22', '2020-12-31T23', '2021-01-01T00'],
+                         dtype='datetime64[s]'),
+                np.array([1., 5., 3.]))
+    for i in range(2):
+        dates, values = arrays_get(root, '06a01', 'p01', 'hour')
+        assert np.array_equal(dates, expected[0])
+        assert np.array_equal(values, expected[1])
+        dates, values = arrays_get(root, '06a01', 'p01', 'day')
+        assert dates.tolist() == [datetime(2021, 1, 1)]
+        assert values.tolist() == [24.]
+        # the results are the same once the store is compacted
+        compact(root)
+
+    dates, values = arrays_get(root, '06a01', 'p01', 'hour',
+                               '2020-12-31 23:00', '2021-01-01')
+    assert values.tolist() == [5., 3.]
+    assert arrays_get(root, '06a01', 'n01', 'hour')[0].size == 0
+    series = series_get(root, '06a01', 'p01', 'hour', '2021-01-01')
+    assert series.to_dict() == {datetime(2021, 1, 1, 0): 3.}